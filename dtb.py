@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+
+# Class reading and editing the ICM docking parameters (.dtb) of a VS project,
+# shared by vs_maps.py and vs_build.py
+#
+# https://github.com/thomas-coudrat/toolbx_vs
+# Thomas Coudrat <thomas.coudrat@gmail.com>
+
+import os
+import re
+import shutil
+import tempfile
+
+
+class dtb:
+    """
+    Docking parameters of a .dtb file, where each keyword line is followed by
+    the line holding its value. The file is read once, edited in memory and
+    written back in a single atomic write
+    """
+
+    def __init__(self, dtbPath):
+        """
+        Read the .dtb file and index its keyword lines
+        """
+
+        self.dtbPath = dtbPath
+        with open(dtbPath, "r") as dtbFile:
+            self.lines = dtbFile.read().splitlines()
+
+        # Line numbers of each keyword, its value is on the next line
+        self.keywords = {}
+        for lineNumber, line in enumerate(self.lines):
+            self.keywords.setdefault(line.strip(), []).append(lineNumber)
+
+    def find(self, keyword):
+        """
+        Return the line numbers of this keyword. Lines merely containing the
+        keyword are used when no line is exactly the keyword
+        """
+
+        if keyword in self.keywords:
+            return self.keywords[keyword]
+
+        return [lineNumber for lineNumber, line in enumerate(self.lines)
+                if keyword in line]
+
+    def getRaw(self, keyword):
+        """
+        Return the stripped value line of a keyword, None if it is not found
+        """
+
+        lineNumbers = self.find(keyword)
+        if not lineNumbers or lineNumbers[0] + 1 >= len(self.lines):
+            return None
+
+        return self.lines[lineNumbers[0] + 1].strip()
+
+    def get(self, keyword):
+        """
+        Return the value of a keyword typed by its prefix: int for i_, float
+        for r_, bool for l_ (yes/no) and string otherwise
+        """
+
+        val = self.getRaw(keyword)
+        if val is None:
+            return None
+
+        prefix = keyword[:2]
+        if prefix == "i_":
+            return int(val)
+        elif prefix == "r_":
+            return float(val)
+        elif prefix == "l_":
+            return val == "yes"
+        else:
+            return val
+
+    def set(self, edits):
+        """
+        Replace the value line of each keyword of the edits dictionary with
+        the (unstripped) value given. Nothing is written until write()
+        """
+
+        for keyword, val in edits.items():
+            for lineNumber in self.find(keyword):
+                if lineNumber + 1 < len(self.lines):
+                    self.lines[lineNumber + 1] = val
+                else:
+                    self.lines.append(val)
+
+    def write(self):
+        """
+        Write the parameters back to the .dtb file, through a temporary file
+        renamed over it
+        """
+
+        dtbDir = os.path.dirname(os.path.abspath(self.dtbPath))
+        tempFd, tempPath = tempfile.mkstemp(prefix="tmp_", suffix=".dtb",
+                                            dir=dtbDir)
+        with os.fdopen(tempFd, "w") as tempFile:
+            tempFile.write("\n".join(self.lines) + "\n")
+        shutil.copymode(self.dtbPath, tempPath)
+        os.rename(tempPath, self.dtbPath)
+
+    def params(self, regEx):
+        """
+        Return the (keyword, value) pairs of the lines matching regEx
+        """
+
+        pairs = []
+        for lineNumber, line in enumerate(self.lines[:-1]):
+            if re.search(regEx, line):
+                pairs.append((line.strip(),
+                              self.lines[lineNumber + 1].strip()))
+
+        return pairs
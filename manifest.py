@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+
+# Class reading the manifest of a VS (vs_manifest.json written by
+# vs_build.py): its repeats, slices, ligand ID intervals, expected output
+# files and job scripts. Shared by vs_submit.py, vs_report.py, vs_results.py
+# and vs_poses.py, which fall back to listing the VS directory when there is
+# no manifest
+#
+# https://github.com/thomas-coudrat/toolbx_vs
+# Thomas Coudrat <thomas.coudrat@gmail.com>
+
+import os
+import re
+import json
+
+
+MANIFEST = "vs_manifest.json"
+
+
+def load(vsDir):
+    """
+    Return the manifest of a VS directory, None if it has none
+    """
+
+    manifestPath = os.path.join(vsDir, MANIFEST)
+    if not os.path.exists(manifestPath):
+        return None
+
+    return manifest(manifestPath)
+
+
+class manifest:
+    """
+    Layout of a VS as built by vs_build.py. Paths are returned joined to the
+    VS directory
+    """
+
+    def __init__(self, manifestPath):
+        """
+        Read the manifest
+        """
+
+        self.vsDir = os.path.dirname(manifestPath)
+        with open(manifestPath, "r") as manifestFile:
+            self.data = json.load(manifestFile)
+        self.project = self.data["project"]
+
+    def repeats(self):
+        """
+        Return the repeat directory names, in order
+        """
+
+        return sorted(self.data["repeats"].keys(), key=int)
+
+    def thoroughness(self, repeat):
+        """
+        Return the ICM thoroughness a repeat was docked at
+        """
+
+        return self.data["repeats"][repeat].get("thoroughness")
+
+    def jobs(self, extension=None):
+        """
+        Return the job scripts of the last build, only those ending with
+        extension if given
+        """
+
+        return [os.path.join(self.vsDir, job) for job in self.data["jobs"]
+                if not extension or job.endswith("." + extension)]
+
+    def intervals(self, repeat):
+        """
+        Return the ligand ID intervals of a repeat, each a dictionary of its
+        from and to IDs, .ou output and .ob answers file names
+        """
+
+        return [interval for sliceInfo in
+                self.data["repeats"][repeat]["slices"]
+                for interval in sliceInfo["intervals"]]
+
+    def ligandCount(self, repeat):
+        """
+        Return the number of ligands docked by a repeat. Intervals of resumed
+        builds overlap those of the previous build, ligands are counted once
+        """
+
+        ligandCount = 0
+        last = None
+        for lower, upper in sorted([[interval["from"], interval["to"]]
+                                    for interval in self.intervals(repeat)]):
+            if last is not None and lower <= last:
+                lower = last + 1
+            if upper >= lower:
+                ligandCount += upper - lower + 1
+            last = upper if last is None else max(last, upper)
+
+        return ligandCount
+
+    def outputs(self, repeat=None):
+        """
+        Return the .ou outputs expected in a repeat, or in all repeats. With
+        checkpoints, the _p<N> part files found in the repeat directory are
+        included. The intervals of a slice docked from a sub-library share
+        its output, listed once
+        """
+
+        repeats = [repeat] if repeat else self.repeats()
+
+        ouPaths = []
+        for repeat in repeats:
+            repeatDir = os.path.join(self.vsDir, repeat)
+            outputs = []
+            seen = set()
+            for interval in self.intervals(repeat):
+                if interval["output"] not in seen:
+                    outputs.append(interval["output"])
+                    seen.add(interval["output"])
+            if self.data["repeats"][repeat].get("checkpoint"):
+                bases = set([output[:-len(".ou")] for output in outputs])
+                outputs += sorted([fileName for fileName in
+                                   os.listdir(repeatDir)
+                                   if re.match(r".*_p\d+\.ou$", fileName) and
+                                   re.sub(r"_p\d+\.ou$", "", fileName)
+                                   in bases])
+            ouPaths += [os.path.join(repeatDir, output) for output in outputs]
+
+        return ouPaths
+
+    def answers(self, repeat):
+        """
+        Return the [path, first ligand ID] of the .ob answers files of a
+        repeat, None when checkpoints restart them at unknown IDs
+        """
+
+        if self.data["repeats"][repeat].get("checkpoint"):
+            return None
+
+        repeatDir = os.path.join(self.vsDir, repeat)
+        return [[os.path.join(repeatDir, interval["answers"]),
+                 interval["from"]] for interval in self.intervals(repeat)]
+
+    def localID(self, repeat, ligID):
+        """
+        Return the ID of a ligand in the answers of a repeat: its position in
+        the sub-library of its slice if it was docked from one. The intervals
+        of the last build come last
+        """
+
+        localID = ligID
+        for interval in self.intervals(repeat):
+            if interval["from"] <= ligID <= interval["to"]:
+                localID = ligID - interval.get("idOffset", 0)
+
+        return localID
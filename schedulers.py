@@ -0,0 +1,465 @@
+#!/usr/bin/env python
+
+# Scheduler backends shared by vs_build.py and vs_submit.py. Each backend
+# renders the header of its job scripts, and submits, queries and cancels
+# jobs: slurm, sge, local (slices run on the current machine) and mock, which
+# simulates the queue latency and run time of the jobs on a virtual clock to
+# benchmark submission and resubmission strategies without a cluster.
+#
+# https://github.com/thomas-coudrat/toolbx_vs
+# Thomas Coudrat <thomas.coudrat@gmail.com>
+
+import os
+import re
+import math
+import time
+import heapq
+import random
+import subprocess
+
+
+# Job states returned by query()
+PENDING = "PENDING"
+RUNNING = "RUNNING"
+COMPLETED = "COMPLETED"
+FAILED = "FAILED"
+CANCELLED = "CANCELLED"
+
+FINISHED = (COMPLETED, FAILED, CANCELLED)
+
+
+def getScheduler(queue, **options):
+    """
+    Return the backend of a queuing system. slurm-srun scripts are SLURM
+    scripts
+    """
+
+    backends = {"slurm": slurm, "slurm-srun": slurm, "sge": sge,
+                "local": local, "mock": mock}
+    if queue not in backends:
+        raise ValueError("Unknown queuing system: " + queue)
+
+    return backends[queue](**options)
+
+
+def parseWalltime(walltime):
+    """
+    Convert a [D-]HH:MM:SS walltime to seconds
+    """
+
+    days = 0
+    if "-" in walltime:
+        days, walltime = walltime.split("-")
+    seconds = 0
+    for field in walltime.split(":"):
+        seconds = seconds * 60 + int(float(field))
+
+    return int(days) * 86400 + seconds
+
+
+def formatWalltime(seconds):
+    """
+    Convert seconds to a HH:MM:SS walltime
+    """
+
+    seconds = int(math.ceil(seconds))
+    return "{:02d}:{:02d}:{:02d}".format(seconds // 3600, seconds % 3600 // 60,
+                                         seconds % 60)
+
+
+def sgeMemory(memory):
+    """
+    SGE memory request for a number of MB, in G when round
+    """
+
+    if memory % 1024 == 0:
+        return str(memory // 1024) + "G"
+    else:
+        return str(memory) + "M"
+
+
+class scheduler:
+    """
+    Interface of the scheduler backends. Scripts are submitted from their
+    own directory, and jobs are referred to by the ID submit() returns
+    """
+
+    # Extension of the job scripts, directive holding their walltime, and
+    # variable holding the array task index
+    extension = None
+    timeDirective = None
+    taskID = None
+
+    def header(self, jobName, walltime=None, memory=1024, checkpoint=False,
+               tasks=None, throttle=None, ntasks=None):
+        """
+        Return the first lines of a job script: shell and scheduler
+        directives. tasks is the task range of an array job, ntasks the
+        number of tasks of an allocation, memory then being per task
+        """
+
+        raise NotImplementedError
+
+    def submit(self, scriptPath):
+        """
+        Submit a job script, return its job ID, None if the submission failed
+        """
+
+        raise NotImplementedError
+
+    def query(self, jobID):
+        """
+        Return the state of a job: PENDING, RUNNING, COMPLETED, FAILED or
+        CANCELLED
+        """
+
+        raise NotImplementedError
+
+    def cancel(self, jobID):
+        """
+        Cancel a pending or running job
+        """
+
+        raise NotImplementedError
+
+    def now(self):
+        """
+        Current time in seconds
+        """
+
+        return time.time()
+
+    def sleep(self, seconds):
+        """
+        Wait between submissions or queries
+        """
+
+        time.sleep(seconds)
+
+    def readWalltime(self, scriptPath):
+        """
+        Return the walltime in seconds requested by a job script, None if it
+        has none
+        """
+
+        if not self.timeDirective:
+            return None
+
+        with open(scriptPath, "r") as scriptFile:
+            for line in scriptFile:
+                if line.startswith(self.timeDirective):
+                    return parseWalltime(line[len(self.timeDirective):]
+                                         .strip())
+
+        return None
+
+    def submitWith(self, args, scriptPath, jobPattern):
+        """
+        Submit a script with a scheduler command, and return the job ID found
+        in its output by jobPattern. A failed command, or an output without a
+        job ID, is reported and None returned
+        """
+
+        try:
+            output = self.run(args, scriptPath)
+        except (OSError, subprocess.CalledProcessError) as e:
+            print("Submission of " + scriptPath + " failed: " + str(e))
+            return None
+        print(output.strip())
+
+        match = re.search(jobPattern, output)
+        if not match:
+            print("Submission of " + scriptPath + " failed, no job ID in: " +
+                  output.strip())
+            return None
+
+        return match.group(1)
+
+    def run(self, args, scriptPath):
+        """
+        Run a scheduler command on a script from its directory, return its
+        output
+        """
+
+        return subprocess.check_output(args + [os.path.basename(scriptPath)],
+                                       cwd=os.path.dirname(
+                                           os.path.abspath(scriptPath)),
+                                       universal_newlines=True)
+
+
+class slurm(scheduler):
+    """
+    SLURM backend: sbatch, squeue (sacct once the job left the queue) and
+    scancel
+    """
+
+    extension = "slurm"
+    timeDirective = "#SBATCH --time="
+    taskID = "$SLURM_ARRAY_TASK_ID"
+
+    # SLURM states mapped onto those of query()
+    states = {"PENDING": PENDING, "CONFIGURING": PENDING,
+              "REQUEUED": PENDING, "RUNNING": RUNNING,
+              "COMPLETING": RUNNING, "COMPLETED": COMPLETED,
+              "CANCELLED": CANCELLED}
+
+    def header(self, jobName, walltime=None, memory=1024, checkpoint=False,
+               tasks=None, throttle=None, ntasks=None):
+
+        lines = []
+        lines.append("#!/bin/bash")
+        if ntasks:
+            lines.append("#SBATCH --ntasks=" + str(ntasks))
+            lines.append("#SBATCH --mem-per-cpu=" + str(memory))
+        else:
+            lines.append("#SBATCH --mem=" + str(memory))
+        lines.append("#SBATCH --time=" + walltime)
+        lines.append("#SBATCH --job-name=" + jobName)
+        if tasks:
+            if throttle:
+                tasks += "%" + str(throttle)
+            lines.append("#SBATCH --array=" + tasks)
+        if checkpoint:
+            lines.append("#SBATCH --requeue")
+
+        return lines
+
+    def submit(self, scriptPath):
+
+        return self.submitWith(["sbatch"], scriptPath, r"job (\d+)")
+
+    def query(self, jobID):
+
+        output = subprocess.check_output(["squeue", "-h", "-j", jobID,
+                                          "-o", "%T"],
+                                         universal_newlines=True)
+        if not output.strip():
+            output = subprocess.check_output(["sacct", "-n", "-X", "-P", "-j",
+                                              jobID, "-o", "State"],
+                                             universal_newlines=True)
+        if not output.strip():
+            return COMPLETED
+
+        # Array jobs are finished once all of their tasks are
+        states = [self.states.get(state.split()[0], FAILED)
+                  for state in output.splitlines() if state.strip()]
+        for state in (RUNNING, PENDING, FAILED, CANCELLED):
+            if state in states:
+                return state
+
+        return COMPLETED
+
+    def cancel(self, jobID):
+
+        subprocess.call(["scancel", jobID])
+
+
+class sge(scheduler):
+    """
+    SGE backend: qsub, qstat (qacct once the job left the queue) and qdel
+    """
+
+    extension = "sge"
+    timeDirective = "#$ -l h_rt="
+    taskID = "$SGE_TASK_ID"
+
+    def header(self, jobName, walltime=None, memory=1024, checkpoint=False,
+               tasks=None, throttle=None, ntasks=None):
+
+        lines = []
+        lines.append("#!/bin/sh")
+        lines.append("#$ -S /bin/sh")
+        lines.append("#$ -l h_rt=" + walltime)
+        lines.append("#$ -l h_vmem=" + sgeMemory(memory))
+        lines.append("#$ -q hqu9")
+        lines.append("#$ -l dpod=1")
+        lines.append("#$ -cwd")
+        lines.append("#$ -N " + str(jobName))
+        if tasks:
+            lines.append("#$ -t " + tasks)
+            if throttle:
+                lines.append("#$ -tc " + str(throttle))
+        if checkpoint:
+            lines.append("#$ -r y")
+
+        return lines
+
+    def submit(self, scriptPath):
+
+        return self.submitWith(["qsub"], scriptPath, r"job(?:-array)? (\d+)")
+
+    def query(self, jobID):
+
+        states = []
+        output = subprocess.check_output(["qstat"], universal_newlines=True)
+        for line in output.splitlines():
+            fields = line.split()
+            if fields and fields[0] == jobID:
+                states.append(fields[4])
+        if states:
+            if [state for state in states if "E" in state]:
+                return FAILED
+            if [state for state in states if "r" in state or "t" in state]:
+                return RUNNING
+            return PENDING
+
+        # Exit status of the tasks of a finished job
+        output = subprocess.check_output(["qacct", "-j", jobID],
+                                         universal_newlines=True)
+        for line in output.splitlines():
+            fields = line.split()
+            if fields and fields[0] in ("failed", "exit_status") and \
+                    fields[1] != "0":
+                return FAILED
+
+        return COMPLETED
+
+    def cancel(self, jobID):
+
+        subprocess.call(["qdel", jobID])
+
+
+class local(scheduler):
+    """
+    Local backend: the scripts are run with bash on the current machine. The
+    docking executable can be replaced by icmExec
+    """
+
+    extension = "local"
+
+    def __init__(self, icmExec=None):
+
+        self.icmExec = icmExec
+        self.processes = {}
+
+    def header(self, jobName, walltime=None, memory=1024, checkpoint=False,
+               tasks=None, throttle=None, ntasks=None):
+
+        return ["#!/bin/bash"]
+
+    def submit(self, scriptPath):
+
+        env = os.environ.copy()
+        if self.icmExec:
+            env["ICMEXEC"] = self.icmExec
+
+        process = subprocess.Popen(["bash", os.path.basename(scriptPath)],
+                                   cwd=os.path.dirname(
+                                       os.path.abspath(scriptPath)),
+                                   env=env)
+        jobID = str(process.pid)
+        self.processes[jobID] = process
+
+        return jobID
+
+    def query(self, jobID):
+
+        status = self.processes[jobID].poll()
+        if status is None:
+            return RUNNING
+        elif status == 0:
+            return COMPLETED
+        elif status < 0:
+            return CANCELLED
+        else:
+            return FAILED
+
+    def exitStatus(self, jobID):
+        """
+        Exit status of a finished job, None while it runs
+        """
+
+        return self.processes[jobID].poll()
+
+    def cancel(self, jobID):
+
+        if self.processes[jobID].poll() is None:
+            self.processes[jobID].terminate()
+            self.processes[jobID].wait()
+
+
+class mock(slurm):
+    """
+    Simulated SLURM cluster. Nothing is run: each job waits latency seconds
+    on average in the queue and for a free slot, then runs for runtime
+    seconds on average (the walltime of its script at most, past which it
+    fails), and fails with a probability failRate. Time is virtual: sleep()
+    advances the clock instead of waiting, submissions costing submitTime
+    seconds each. Cancelled jobs hold their slot until their planned end
+    """
+
+    def __init__(self, latency=30., runtime=600., failRate=0., slots=None,
+                 submitTime=0.1, seed=None):
+
+        self.latency = latency
+        self.runtime = runtime
+        self.failRate = failRate
+        self.slots = slots
+        self.submitTime = submitTime
+        self.random = random.Random(seed)
+        self.clock = 0.
+        self.jobs = {}
+        # End times of the jobs holding the slots
+        self.busy = []
+
+    def now(self):
+
+        return self.clock
+
+    def sleep(self, seconds):
+
+        self.clock += seconds
+
+    def submit(self, scriptPath):
+
+        self.clock += self.submitTime
+
+        # Jobs start in submission order, once past their queue latency and
+        # given a free slot
+        start = self.clock + self.random.expovariate(1. / self.latency) \
+            if self.latency else self.clock
+        if self.slots:
+            if len(self.busy) >= self.slots:
+                start = max(start, heapq.heappop(self.busy))
+
+        # Jobs past their walltime are killed, failing ones stop at a random
+        # point of their run
+        runtime = self.runtime * self.random.uniform(0.5, 1.5)
+        failed = False
+        walltime = self.readWalltime(scriptPath)
+        if walltime is not None and runtime > walltime:
+            runtime = walltime
+            failed = True
+        if self.random.random() < self.failRate:
+            runtime *= self.random.random()
+            failed = True
+
+        end = start + runtime
+        if self.slots:
+            heapq.heappush(self.busy, end)
+
+        jobID = str(len(self.jobs) + 1)
+        self.jobs[jobID] = {"submit": self.clock, "start": start, "end": end,
+                            "failed": failed, "cancelled": None}
+
+        return jobID
+
+    def query(self, jobID):
+
+        job = self.jobs[jobID]
+        if job["cancelled"] is not None:
+            return CANCELLED
+        if self.clock < job["start"]:
+            return PENDING
+        if self.clock < job["end"]:
+            return RUNNING
+        if job["failed"]:
+            return FAILED
+
+        return COMPLETED
+
+    def cancel(self, jobID):
+
+        job = self.jobs[jobID]
+        if job["cancelled"] is None and self.clock < job["end"]:
+            job["cancelled"] = self.clock
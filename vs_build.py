@@ -2,20 +2,93 @@
 
 # Builds the files to split a VS into separate slices to be ran in parallel on
 # an HPC cluster using the SLURM or PBS queuing system.
+# A slice is a list of ligand ID intervals, each docked by its own ICM call:
+# ligands left out of the VS (by the --props filter, as --dupes duplicate
+# structures, or not selected by a stage) split the intervals. As every ICM
+# call loads the maps again, gaps of at most --gap ligands are docked through
+# instead (not with --sublib, whose slices are docked in a single ICM call).
+# With --cost, slices are cut to roughly equal predicted docking cost instead
+# of equal ligand counts, keeping the number of slices sliceSize gives.
+# With -array, the slices are listed in a single <projName>_slices.tsv table
+# and each repeat gets one SLURM/SGE array script, whose tasks look up their
+# ligand intervals in that table, instead of one script per slice.
+# With --store, the setup files are kept once in a content-addressed store
+# (named after their SHA-1, read-only), and the repeat directories hold hard
+# links to them, symbolic links across filesystems, or copies as a last
+# resort, rather than a copy of the setup each.
+# With -resume, the files of the repeat directories are kept: the ligands
+# with a SCORES> line in the .ou files of a repeat are not docked again, and
+# its slices only cover the missing ligand ID intervals. The previous slice
+# scripts are moved to a backup_<time> directory.
+# With -checkpoint, the job scripts dock each interval through a shell
+# function restarting after the last ligand with a SCORES> line in the .ou
+# of a previous run of the job, writing to a new _p<N> part file. Requeued or
+# resubmitted jobs then lose at most one ligand of work.
+# With slurm-srun and --workers N, the allocation runs N vs_worker.py tasks
+# pulling the slices from a shared queue file until it is empty, instead of
+# one srun task per slice.
+# With --history and --sacct, the walltime and memory of each job are sized
+# from a previous VS: core-seconds per ligand docked and peak memory taken
+# from a sacct export of its jobs, with a safety margin. The walltime given
+# on the command line becomes the upper limit. Walltime is sized per job from
+# its ligand count, memory is a single value for the whole VS: ICM holds the
+# maps and one ligand at a time, whatever the size of the slice.
+# With --top, repeats are staged: the first repeat docks every ligand, and
+# each build after its results are in prepares the next repeat, docking only
+# the ligands in the top X% of the best scores of the completed repeats, or
+# (with --spread) whose scores across them still differ by more than a
+# tolerance. A stage is only built once every ligand interval of the previous
+# one has results.
+# With --funnel, the stages are docked at increasing thoroughness: stage 1
+# docks every ligand at the thoroughness argument, and each following stage
+# the top percentage of the ligands scored by the previous stage, at its own
+# thoroughness.
+# With --interleave, the ligands are cut into chunks dealt to the slices in
+# turn (in a shuffled order within each stratum of chunks with -stratify), so
+# that any slice, and any early fraction of completed slices, is a
+# representative sample of the library. The slices are listed in the slice
+# table.
+# With --sublib, the ligands of each slice are written to their own small
+# sub-library, cut from the library through the byte offsets of its .idx
+# index (vs_index.py -native), so that the jobs do not all read the full
+# library. Each job docks its sub-library in a single ICM call from a staging
+# directory, on the node-local $TMPDIR with -tmpdir, and gives the SCORES>
+# lines their library IDs back from the .ids list written next to the
+# sub-library. Scattered ligands, such as those selected by a stage, are then
+# docked without an ICM call each.
+# The layout of the VS (setup checksums, repeats, slices, ligand ID
+# intervals, expected output files and job scripts) is written to
+# vs_manifest.json, read by the other tools instead of listing the VS
+# directory.
+# The local queuing system writes plain .local slice scripts, run on the
+# current machine by vs_submit.py with a bounded pool of processes.
+# The headers of the job scripts are rendered by the scheduler backends of
+# schedulers.py.
 #
 # https://github.com/thomas-coudrat/toolbx_vs
 # Thomas Coudrat <thomas.coudrat@gmail.com>
 
 import os
 import argparse
+import array
+import bisect
+import csv
 import glob
+import hashlib
+import math
+import tempfile
 import shutil
-import re
 import sys
 import socket
 import json
 import datetime
+import random
 import time
+import dtb
+import schedulers
+import vs_index
+import vs_results
+import manifest
 
 def main():
     """
@@ -24,7 +97,10 @@ def main():
 
     # Getting all the args
     libStart, libEnd, sliceSize, repeatNum, thor, \
-        walltime, setupDir, projName, queue = parsing()
+        walltime, setupDir, projName, queue, propsDir, dupPath, \
+        costPath, arrayJobs, throttle, storeDir, resume, checkpoint, \
+        workers, historyDir, sacctPath, margin, top, spread, \
+        funnel, interleave, stratify, idxPath, tmpdir, gap = parsing()
 
     # Get the path from the Json file
     icmHome = getPath()
@@ -36,9 +112,28 @@ def main():
     # Get current working directory
     workDir = os.getcwd()
 
-    # Clean files present in the current repeat directories, if any
+    # Staged repeats: the repeat to build is the first without results
+    stage = None
+    if top or funnel:
+        stage = nextStage(repeatNum)
+
+    # Funnel stages after the first dock the top of the previous stage, at
+    # their own thoroughness
+    first = 1
+    if funnel and stage > 1:
+        top, thor = funnel[stage - 2]
+        first = stage - 1
+
+    # Clean files present in the current repeat directories, if any. When
+    # resuming, or for the completed stages, only the previous slice scripts
+    # are put aside. Repeat directories are named after their number only
     for repeatDir in glob.glob(workDir + "/[0-9]*"):
-        cleanRepeatDir(repeatDir)
+        if not os.path.basename(repeatDir).isdigit():
+            continue
+        if resume or (stage and int(os.path.basename(repeatDir)) < stage):
+            backupScripts(repeatDir)
+        else:
+            cleanRepeatDir(repeatDir)
 
     reportLines.append("\nPARAMETERS:\n")
     reportLines.append("\t libStart: " + str(libStart))
@@ -49,21 +144,143 @@ def main():
     reportLines.append("\t thoroughness: " + thor)
     reportLines.append("\t setupDir: " + setupDir)
     reportLines.append("\t projName: " + projName)
+    if propsDir:
+        reportLines.append("\t props: " + propsDir)
+    if dupPath:
+        reportLines.append("\t dupes: " + dupPath)
+    if propsDir or dupPath or stage:
+        reportLines.append("\t gap: " + str(gap))
+    if costPath:
+        reportLines.append("\t cost: " + costPath)
+    if arrayJobs:
+        reportLines.append("\t array: " + (str(throttle) + " tasks at a time"
+                                           if throttle else "yes"))
+    if storeDir:
+        reportLines.append("\t store: " + storeDir)
+    if resume:
+        reportLines.append("\t resume: yes")
+    if checkpoint:
+        reportLines.append("\t checkpoint: yes")
+    if workers:
+        reportLines.append("\t workers: " + str(workers))
+    if idxPath:
+        reportLines.append("\t sublib: " + idxPath +
+                           (", staged to $TMPDIR" if tmpdir else ""))
+    if interleave:
+        reportLines.append("\t interleave: chunks of " + str(interleave) +
+                           " ligands" + (", stratified" if stratify else ""))
+    if historyDir:
+        reportLines.append("\t history: " + historyDir + ", " + sacctPath +
+                           " (margin " + str(margin) + ")")
+    if funnel:
+        reportLines.append("\t funnel: " + ", ".join(
+            ["top " + str(funnelTop) + "% at " + funnelThor for
+             funnelTop, funnelThor in funnel]) + ", stage " + str(stage) +
+            " of " + str(repeatNum))
+    elif stage:
+        reportLines.append("\t staged: top " + str(top) + "%" +
+                           (", spread > " + str(spread)
+                            if spread is not None else "") +
+                           ", stage " + str(stage) + " of " + str(repeatNum))
     reportLines.append("\n")
 
+    # Docking parameters of the setup
+    dtbParams = dtb.dtb(glob.glob(setupDir + "/*.dtb")[0])
+
     # grep the parameters to lookout for in the .dtb file, and print them out
-    reportLines = printParams(setupDir, reportLines)
+    reportLines = printParams(dtbParams, reportLines)
 
     reportLines.append("\n***********************\n")
 
     # Creating the repeats directories, which are copies of the setupDir
-    reportLines = createRepeats(repeatNum, setupDir, reportLines)
+    reportLines, setupDigests = createRepeats(repeatNum, setupDir,
+                                              reportLines, storeDir, stage)
 
     reportLines.append("\n***********************\n")
 
+    # Ligand ID intervals to dock, leaving out the ligands that would be
+    # skipped by ICM given the .dtb limits
+    intervals = [[libStart, libEnd]]
+    if propsDir:
+        intervals, reportLines = filterProps(intervals, propsDir, dtbParams,
+                                             reportLines, gap)
+        reportLines.append("\n***********************\n")
+
+    # Dock only the first copy of duplicate structures, vs_results.py gives
+    # its score back to the others
+    if dupPath:
+        intervals, reportLines = filterDupes(intervals, dupPath, reportLines,
+                                             gap)
+        reportLines.append("\n***********************\n")
+
+    # Ligands left to dock in each repeat: all of them, or those without
+    # results yet when resuming. Staged repeats only dock in the repeat of
+    # this stage, the ligands selected from the results of the previous ones
+    if resume:
+        repeatIntervals, reportLines = resumeIntervals(intervals, repeatNum,
+                                                       reportLines)
+        reportLines.append("\n***********************\n")
+    elif stage:
+        if stage > 1:
+            intervals, reportLines = stageIntervals(intervals, stage, top,
+                                                    spread, reportLines,
+                                                    first, gap)
+            reportLines.append("\n***********************\n")
+        repeatIntervals = [[]] * (stage - 1) + [intervals]
+    else:
+        repeatIntervals = [intervals] * repeatNum
+
+    # Cut them into slices of sliceSize ligands, or into as many slices of
+    # equal predicted cost
+    repeatSlices = []
+    for intervals in repeatIntervals:
+        if costPath:
+            slices, reportLines = planCostSlices(intervals, sliceSize,
+                                                 costPath, reportLines)
+            reportLines.append("\n***********************\n")
+        elif interleave:
+            slices = planInterleavedSlices(intervals, sliceSize, interleave,
+                                           stratify)
+        else:
+            slices = planSlices(intervals, sliceSize)
+        repeatSlices.append(slices)
+
+    # The slices of array jobs are read from a table, that of interleaved
+    # slices records which chunks each slice docks
+    # Sub-library of the ligands of each slice, docked instead of the full
+    # library
+    sublibs = None
+    setupNames = None
+    if idxPath:
+        sublibs, reportLines = writeSublibs(repeatSlices, idxPath, workDir,
+                                            projName, reportLines)
+        setupNames = sorted([os.path.basename(filePath) for filePath in
+                             glob.glob(setupDir + "/*")])
+        reportLines.append("\n***********************\n")
+
+    if arrayJobs or interleave:
+        reportLines = writeSliceTable(repeatSlices, projName, workDir,
+                                      reportLines, resume, interleave,
+                                      stratify, sublibs)
+
+    # Walltime and memory of the jobs learnt from a previous VS
+    sizing = None
+    if historyDir:
+        sizing, reportLines = readHistory(historyDir, sacctPath, margin,
+                                          reportLines)
+        reportLines.append("\n***********************\n")
+
     # Create the .slurm slices
-    reportLines = createSlices(libStart, libEnd, sliceSize, walltime, thor,
-                               projName, repeatNum, queue, reportLines, icmHome)
+    reportLines = createSlices(repeatSlices, libStart, libEnd, walltime, thor,
+                               projName, queue, reportLines, icmHome,
+                               arrayJobs, throttle, resume, checkpoint,
+                               workers, sizing, sublibs, setupNames, tmpdir)
+
+    # Layout of the VS for the other tools
+    reportLines = writeManifest(repeatSlices, libStart, libEnd, thor,
+                                projName, queue, setupDir, workDir,
+                                reportLines, arrayJobs, resume, checkpoint,
+                                stage, sublibs, setupDigests)
 
     reportLines.append("\n")
 
@@ -85,7 +302,71 @@ def parsing():
     descr_thor = "Thoroughness of the docking (format: 5.)"
     descr_walltime = "Walltime for a single slice (format: 1-24:00:00)"
     descr_setupDir = "Name of the directory containing setup files"
-    descr_queue = "Queuing system to be used (sge/slurm/slurm-srun)"
+    descr_queue = "Queuing system to be used (sge/slurm/slurm-srun/local)"
+    descr_props = "Ligand property sidecar (_props directory written by " \
+        "vs_index.py -native -props). Ligands exceeding the maxHdonor, " \
+        "maxLigSize, maxNO or maxTorsion limits of the .dtb are left out"
+    descr_gap = "Ligands left out by --props, --dupes or a stage split the " \
+        "ligand ID intervals, each docked by its own ICM call loading the " \
+        "maps again. Gaps of at most this many ligands are docked through " \
+        "instead, ICM skipping the ligands over the .dtb limits itself and " \
+        "docking the duplicates and ligands not selected. Default is 10, " \
+        "not used with --sublib"
+    descr_dupes = "Duplicate report (.dup written by vs_index.py -native " \
+        "-dedup). Duplicate ligands are left out, only their canonical ID " \
+        "is docked"
+    descr_cost = "Per-ligand docking cost estimates: a _props directory " \
+        "(cost from heavy atom and rotatable bond counts) or a CSV of " \
+        "ligID,seconds from previous dockings. Slices are cut to equal " \
+        "predicted cost, the number of slices staying that of sliceSize"
+    descr_array = "Write one array job per repeat (sge/slurm), its tasks " \
+        "reading their ligand intervals from <projName>_slices.tsv, instead " \
+        "of one script per slice"
+    descr_throttle = "Array mode: maximum number of tasks of an array " \
+        "running at the same time"
+    descr_resume = "Keep the results of the repeat directories and only " \
+        "slice the ligands without a SCORES> line in their .ou files yet"
+    descr_checkpoint = "Job scripts restart each ligand interval after " \
+        "the last ligand docked by a previous run of the job (requeued or " \
+        "resubmitted), in a new .ou part file"
+    descr_workers = "slurm-srun: number of vs_worker.py tasks of the " \
+        "allocation, pulling the slices from a shared queue until it is " \
+        "empty, instead of one srun task per slice"
+    descr_history = "Directory of a previous VS of similar ligands, whose " \
+        ".ou files give the number of ligands docked. Requires --sacct"
+    descr_sacct = "sacct export of the jobs of the --history VS (sacct -P " \
+        "-o JobID,JobName,Elapsed,MaxRSS,AllocCPUS), giving their run time " \
+        "and peak memory. Walltime (capped by the walltime argument) and " \
+        "memory of each job are sized from them"
+    descr_margin = "Safety factor applied to the walltime and memory sized " \
+        "from --history. Default is 1.5"
+    descr_top = "Staged repeats: the first build docks all ligands in " \
+        "repeat 1, each following build (once the previous repeats are " \
+        "docked) builds the next repeat for the ligands in this top " \
+        "percentage of the best scores so far"
+    descr_spread = "Staged repeats: also dock in the next repeat the " \
+        "ligands whose scores across the previous repeats differ by more " \
+        "than this tolerance"
+    descr_funnel = "Thoroughness funnel, one top:thor pair per stage after " \
+        "the first (e.g. 10:5.,1:20.). The first build docks all ligands in " \
+        "repeat 1 at the thoroughness argument, each following build the " \
+        "top percentage of the ligands of the previous stage at the " \
+        "thoroughness given. repeatNum is the number of stages"
+    descr_interleave = "Cut the ligands into chunks of this size, dealt " \
+        "to the slices in turn, so that any early fraction of completed " \
+        "slices is a representative sample of the library. Each chunk is " \
+        "docked by its own ICM call, unless docked from a sub-library"
+    descr_stratify = "Interleave mode: deal the chunks of each stratum (one " \
+        "chunk per slice) in a shuffled, deterministic order"
+    descr_sublib = "Native .idx index of the library (vs_index.py " \
+        "-native). The ligands of each slice are written to their own " \
+        "sub-library in sublib/, docked by the job in a single ICM call " \
+        "instead of the full library of the .dtb"
+    descr_tmpdir = "Sub-library mode: the jobs copy their sub-library to " \
+        "the node-local $TMPDIR (/tmp by default) and dock it from there"
+    descr_store = "Content-addressed store (may be shared between VSs) " \
+        "keeping a single read-only copy of the setup files, linked into " \
+        "the repeat directories instead of copied"
 
     # Defining the arguments
     parser = argparse.ArgumentParser(description=descr)
@@ -97,6 +378,28 @@ def parsing():
     parser.add_argument("walltime", help=descr_walltime)
     parser.add_argument("setupDir", help=descr_setupDir)
     parser.add_argument("queue", help=descr_queue)
+    parser.add_argument("--props", help=descr_props)
+    parser.add_argument("--gap", help=descr_gap)
+    parser.add_argument("--dupes", help=descr_dupes)
+    parser.add_argument("--cost", help=descr_cost)
+    parser.add_argument("-array", action="store_true", help=descr_array)
+    parser.add_argument("--throttle", help=descr_throttle)
+    parser.add_argument("--store", help=descr_store)
+    parser.add_argument("-resume", action="store_true", help=descr_resume)
+    parser.add_argument("-checkpoint", action="store_true",
+                        help=descr_checkpoint)
+    parser.add_argument("--workers", help=descr_workers)
+    parser.add_argument("--history", help=descr_history)
+    parser.add_argument("--sacct", help=descr_sacct)
+    parser.add_argument("--margin", help=descr_margin)
+    parser.add_argument("--top", help=descr_top)
+    parser.add_argument("--spread", help=descr_spread)
+    parser.add_argument("--funnel", help=descr_funnel)
+    parser.add_argument("--interleave", help=descr_interleave)
+    parser.add_argument("-stratify", action="store_true",
+                        help=descr_stratify)
+    parser.add_argument("--sublib", help=descr_sublib)
+    parser.add_argument("-tmpdir", action="store_true", help=descr_tmpdir)
 
     # Parsing and storing into variables
     args = parser.parse_args()
@@ -110,17 +413,129 @@ def parsing():
     # VS params
     walltime = args.walltime
     queue = args.queue
+    propsDir = args.props
+    dupPath = args.dupes
+    costPath = args.cost
+    arrayJobs = args.array
+    throttle = args.throttle
+    storeDir = args.store
+    resume = args.resume
+    checkpoint = args.checkpoint
+    workers = args.workers
+    historyDir = args.history
+    sacctPath = args.sacct
+    margin = args.margin
+    top = args.top
+    spread = args.spread
+    funnel = args.funnel
+    interleave = args.interleave
+    stratify = args.stratify
+    idxPath = args.sublib
+    tmpdir = args.tmpdir
+    gap = args.gap
     # Project info
     setupDir = args.setupDir
     dtbFileName = glob.glob(setupDir + "/*.dtb")[0]
     projName = dtbFileName.replace(".dtb", "").split("/")[1]
 
-    if queue not in ("sge", "slurm", "slurm-srun"):
-        print("'sge', 'slurm' and 'slurm-srun' are the queuing system options")
+    if queue not in ("sge", "slurm", "slurm-srun", "local"):
+        print("'sge', 'slurm', 'slurm-srun' and 'local' are the queuing "
+              "system options")
+        sys.exit()
+
+    if costPath and not os.path.exists(costPath):
+        print("Cost estimates not found: " + costPath)
+        sys.exit()
+
+    if arrayJobs and queue not in ("sge", "slurm"):
+        print("Array jobs are available with the 'sge' and 'slurm' queuing "
+              "systems")
+        sys.exit()
+
+    if throttle:
+        throttle = int(throttle)
+
+    if workers:
+        workers = int(workers)
+        if queue != "slurm-srun":
+            print("Workers are available with the 'slurm-srun' queuing system")
+            sys.exit()
+
+    if bool(historyDir) != bool(sacctPath):
+        print("Sizing jobs requires both --history and --sacct")
+        sys.exit()
+
+    if margin:
+        margin = float(margin)
+    else:
+        margin = 1.5
+
+    if gap:
+        gap = int(gap)
+    else:
+        gap = 10
+
+    if top:
+        top = float(top)
+        if not 0 < top <= 100:
+            print("--top is a percentage of the ligands, between 0 and 100")
+            sys.exit()
+        if resume:
+            print("Staged repeats can not be resumed, build the stage again")
+            sys.exit()
+
+    if spread:
+        spread = float(spread)
+        if not top:
+            print("--spread is used with staged repeats (--top)")
+            sys.exit()
+
+    if funnel:
+        if top or resume:
+            print("The funnel can not be combined with --top or -resume")
+            sys.exit()
+        try:
+            funnel = [(float(stage.split(":")[0]), stage.split(":")[1])
+                      for stage in funnel.split(",")]
+        except (ValueError, IndexError):
+            print("The funnel is a list of top:thor stages, e.g. 10:5.,1:20.")
+            sys.exit()
+        if len(funnel) + 1 != repeatNum:
+            print("The funnel has " + str(len(funnel) + 1) + " stages, " +
+                  "set repeatNum to " + str(len(funnel) + 1))
+            sys.exit()
+
+    if interleave:
+        interleave = int(interleave)
+        if costPath:
+            print("Slices are either interleaved or cut to equal cost")
+            sys.exit()
+    elif stratify:
+        print("-stratify is used with --interleave")
+        sys.exit()
+
+    if idxPath:
+        sdfPath = None
+        if os.path.exists(idxPath):
+            sdfPath = vs_index.indexSource(idxPath)
+        if not sdfPath or not os.path.exists(sdfPath):
+            print("Native .idx index and its library not found: " + idxPath)
+            sys.exit()
+        if checkpoint:
+            print("Sub-libraries can not be combined with -checkpoint")
+            sys.exit()
+        idxPath = os.path.abspath(idxPath)
+        # A sub-library only holds the ligands to dock, in a single ICM call
+        gap = 0
+    elif tmpdir:
+        print("-tmpdir is used with --sublib")
         sys.exit()
 
     return libStart, libEnd, sliceSize, repeatNum, thor, walltime, setupDir, \
-        projName, queue
+        projName, queue, propsDir, dupPath, costPath, arrayJobs, throttle, \
+        storeDir, resume, checkpoint, workers, historyDir, sacctPath, \
+        margin, top, spread, funnel, interleave, stratify, idxPath, tmpdir, \
+        gap
 
 
 def getPath():
@@ -172,7 +587,10 @@ def cleanRepeatDir(repeatDir):
         if answer == "delete":
             print("DELETING PREVIOUS FILES...")
             for filePath in filePaths:
-                os.remove(filePath)
+                if os.path.isdir(filePath):
+                    shutil.rmtree(filePath)
+                else:
+                    os.remove(filePath)
         elif answer == "keep":
             print("CONTINUE WITHOUT DELETING FILES...")
         elif answer == 'backup':
@@ -188,44 +606,216 @@ def cleanRepeatDir(repeatDir):
             sys.exit()
 
 
-def printParams(setupDir, reportLines):
+def backupScripts(repeatDir):
+    """
+    Move the slice scripts of a repeat directory to a timestamped backup
+    directory, so that only the slices built for the resumed VS are
+    submitted. Results are left in place
+    """
+
+    scriptPaths = []
+    for ext in ("slurm", "sge", "sh", "local"):
+        scriptPaths += glob.glob(repeatDir + "/*." + ext)
+
+    if scriptPaths:
+        t = time.time()
+        humanTime = datetime.datetime.fromtimestamp(int(t)).strftime('%Y-%m-%d_%H:%M:%S')
+        backupDir = tempfile.mkdtemp(prefix="backup_" + humanTime + "_",
+                                     dir=repeatDir)
+        for scriptPath in scriptPaths:
+            shutil.move(scriptPath, backupDir)
+
+
+def dockedLigands(repeatDir):
+    """
+    Return the set of ligand IDs with a SCORES> line in the .ou files of a
+    repeat directory
+    """
+
+    docked = set()
+    for ouPath in glob.glob(repeatDir + "/*.ou"):
+        with open(ouPath, "r") as ouFile:
+            for line in ouFile:
+                if "SCORES>" in line:
+                    try:
+                        docked.add(int(line.split()[2]))
+                    except (ValueError, IndexError):
+                        continue
+
+    return docked
+
+
+def resumeIntervals(intervals, repeatNum, reportLines):
+    """
+    Ligand ID intervals left to dock in each repeat directory, leaving out
+    the ligands already docked there
+    """
+
+    ligCount = sum([upper - lower + 1 for lower, upper in intervals])
+
+    reportLines.append("RESUME:\n")
+    repeatIntervals = []
+    for repeat in range(1, repeatNum + 1):
+        docked = dockedLigands(str(repeat))
+        missing = filterIntervals(intervals,
+                                  lambda ligID: ligID not in docked)
+        repeatIntervals.append(missing)
+
+        missingCount = sum([upper - lower + 1 for lower, upper in missing])
+        reportLines.append("\t repeat " + str(repeat) + ": " +
+                           str(ligCount - missingCount) + " ligands docked, " +
+                           str(missingCount) + " left in " +
+                           str(len(missing)) + " intervals")
+
+    return repeatIntervals, reportLines
+
+
+def nextStage(repeatNum):
+    """
+    Stage of a staged VS: the first repeat directory without docked ligands.
+    The previous stage must be complete, its jobs may still be running
+    otherwise
+    """
+
+    for repeat in range(1, repeatNum + 1):
+        if not dockedLigands(str(repeat)):
+            if repeat > 1:
+                missing = missingIntervals(str(repeat - 1))
+                if missing:
+                    print("Stage " + str(repeat - 1) + " is not complete, " +
+                          "no SCORES> line yet for the ligand intervals:")
+                    for interval in missing:
+                        print("\t" + str(interval["from"]) + "-" +
+                              str(interval["to"]) + "\t" +
+                              interval["output"])
+                    sys.exit()
+            return repeat
+
+    print("All " + str(repeatNum) + " repeats of this staged VS are docked")
+    sys.exit()
+
+
+def missingIntervals(repeat):
+    """
+    Return the ligand intervals the manifest lists for a repeat without any
+    SCORES> line in its .ou files. Without a manifest, none can be checked
+    """
+
+    vsManifest = manifest.load(os.getcwd())
+    if not vsManifest or repeat not in vsManifest.repeats():
+        return []
+
+    docked = sorted(dockedLigands(repeat))
+    missing = []
+    for interval in vsManifest.intervals(repeat):
+        first = bisect.bisect_left(docked, interval["from"])
+        if first == len(docked) or docked[first] > interval["to"]:
+            missing.append(interval)
+
+    return missing
+
+
+def stageIntervals(intervals, stage, top, spread, reportLines, first=1,
+                   gap=0):
     """
-    Use the grep command to print out common parameters to check
-    when running a VS
+    Ligand ID intervals docked by a stage: the ligands in the top percentage
+    of the best scores of the previous repeats (from repeat first on), and
+    those whose scores across them differ by more than spread. The selected
+    ligands are scattered, the gaps of at most gap ligands between them are
+    docked as well rather than adding an ICM call each
     """
-    dtbPath = glob.glob(setupDir + "/*.dtb")[0]
 
-    dtbFile = open(dtbPath, "r")
-    dtbLines = dtbFile.readlines()
-    dtbFile.close()
+    # Scores of each ligand in the previous repeats, as parsed by vs_results
+    ligDict = {}
+    for repeat in range(first, stage):
+        for ouPath in glob.glob(str(repeat) + "/*.ou"):
+            with open(ouPath, "r") as ouFile:
+                for line in ouFile:
+                    if "SCORES>" in line:
+                        ligDict = vs_results.parseScoreLine(ligDict, line,
+                                                            str(repeat))
+    scores = dict([(ligID, [ligInfo[9] for ligInfo in ligInfos])
+                   for ligID, ligInfos in ligDict.items()])
+
+    # Lowest scores are the best
+    ranked = sorted(scores.keys(), key=lambda ligID: min(scores[ligID]))
+    topIDs = set(ranked[:int(math.ceil(len(ranked) * top / 100.))])
+    spreadIDs = set()
+    if spread is not None:
+        spreadIDs = set([ligID for ligID in scores.keys()
+                         if max(scores[ligID]) - min(scores[ligID]) > spread])
+
+    selected = topIDs | spreadIDs
+    found = [0]
+
+    def keep(ligID):
+        if ligID in selected:
+            found[0] += 1
+            return True
+        return False
+
+    keptIntervals = filterIntervals(intervals, keep, gap)
+    keptCount = sum([upper - lower + 1 for lower, upper in keptIntervals])
+
+    reportLines.append("STAGE " + str(stage) + ":\n")
+    reportLines.append("\t " + str(len(scores)) + " ligands scored in " +
+                       "repeats " + str(first) + "-" + str(stage - 1))
+    if topIDs:
+        reportLines.append("\t top " + str(top) + "%: " + str(len(topIDs)) +
+                           " ligands, score <= " +
+                           str(max([min(scores[ligID])
+                                    for ligID in topIDs])))
+    if spread is not None:
+        reportLines.append("\t spread > " + str(spread) + ": " +
+                           str(len(spreadIDs)) + " ligands")
+    reportLines.append("\t " + str(keptCount) + " ligands to dock in " +
+                       str(len(keptIntervals)) + " intervals, " +
+                       str(keptCount - found[0]) + " of them not " +
+                       "selected but in gaps of at most " + str(gap) +
+                       " ligands")
+
+    return keptIntervals, reportLines
+
+
+def printParams(dtbParams, reportLines):
+    """
+    Print out common parameters of the .dtb to check when running a VS
+    """
 
     regEx = "maxHdonors|maxLigSize|maxNO|maxTorsion|ringFlexLevel|" \
             "sampleRacemic|scoreThreshold|maxPk|minPk|chargeGroups|" \
             "dbIndex|dbType"
 
-    lineNumber = 0
-    for line in dtbLines:
-        if re.search(regEx, line):
-            param = dtbLines[lineNumber].strip()
-            val = dtbLines[lineNumber + 1].strip()
-            reportLines.append("\t" + param + " : " + val)
-        lineNumber += 1
+    for param, val in dtbParams.params(regEx):
+        reportLines.append("\t" + param + " : " + val)
     reportLines.append("\n")
 
     return reportLines
 
 
-def createRepeats(repeatNum, setupDir, reportLines):
+def createRepeats(repeatNum, setupDir, reportLines, storeDir=None,
+                  stage=None):
     """
     Copy the content of the setup directory to however many
-    repeat directories wanted by the user
+    repeat directories wanted by the user. With a store, link its single
+    copy of the setup files instead. With a stage, only the repeat directory
+    of that stage is created. Returns the SHA-1 of each setup file computed
+    for the store, None without one
     """
 
     # Get files in setupDir
     filePaths = glob.glob(setupDir + "/*")
 
+    setupDigests = None
+    if storeDir:
+        storePaths, setupDigests = storeSetup(filePaths, storeDir)
+
+    repeats = range(1, repeatNum + 1)
+    if stage:
+        repeats = [stage]
+
     # Create each repeat dirs, and populate them with files
-    for repeatDir in range(1, repeatNum + 1):
+    for repeatDir in repeats:
 
         repeatDir = str(repeatDir)
         # Create the directory if it doesn't already exist
@@ -238,24 +828,634 @@ def createRepeats(repeatNum, setupDir, reportLines):
         # Copy each file into this new directory
         for filePath in filePaths:
             fileName = os.path.basename(filePath)
-            shutil.copy(filePath, repeatDir + "/" + fileName)
-            reportLines.append("\t COPYING:" + fileName)
+            if storeDir:
+                method = linkFile(storePaths[filePath],
+                                  repeatDir + "/" + fileName)
+                reportLines.append("\t LINKING:" + fileName + " (" + method +
+                                   ")")
+            else:
+                shutil.copy(filePath, repeatDir + "/" + fileName)
+                reportLines.append("\t COPYING:" + fileName)
+
+    return reportLines, setupDigests
+
+
+def storeSetup(filePaths, storeDir):
+    """
+    Add the setup files to the content-addressed store, each named after the
+    SHA-1 of its content and made read-only. Files already stored are not
+    copied again. Returns the store path of each file, and its SHA-1 by
+    file name
+    """
+
+    if not os.path.exists(storeDir):
+        os.makedirs(storeDir)
+
+    storePaths = {}
+    digests = {}
+    for filePath in filePaths:
+        digest = fileSha1(filePath)
+        storePath = os.path.abspath(os.path.join(storeDir, digest))
+
+        if not os.path.exists(storePath):
+            # Copy to a temporary file renamed into place, so that an other
+            # build never links to a partial file
+            tempFd, tempPath = tempfile.mkstemp(prefix="tmp_", dir=storeDir)
+            os.close(tempFd)
+            shutil.copyfile(filePath, tempPath)
+            os.chmod(tempPath, 0o444)
+            os.rename(tempPath, storePath)
+        storePaths[filePath] = storePath
+        digests[os.path.basename(filePath)] = digest
+
+    return storePaths, digests
+
+
+def fileSha1(filePath):
+    """
+    SHA-1 of the content of a file
+    """
+
+    sha = hashlib.sha1()
+    with open(filePath, "rb") as setupFile:
+        for data in iter(lambda: setupFile.read(1024 * 1024), b""):
+            sha.update(data)
+
+    return sha.hexdigest()
+
+
+def linkFile(storePath, filePath):
+    """
+    Link a stored file into a repeat directory: a hard link, or a symbolic
+    link when the store is on an other filesystem, or a copy if neither is
+    possible. Returns the method used
+    """
+
+    if os.path.lexists(filePath):
+        os.remove(filePath)
+
+    try:
+        os.link(storePath, filePath)
+        return "hardlink"
+    except OSError:
+        pass
+    try:
+        os.symlink(storePath, filePath)
+        return "symlink"
+    except OSError:
+        shutil.copy(storePath, filePath)
+        os.chmod(filePath, 0o644)
+        return "copy"
+
+
+def filterProps(intervals, propsDir, dtbParams, reportLines, gap=0):
+    """
+    Leave out of the ligand ID intervals the ligands whose properties exceed
+    the limits set in the .dtb, which ICM would skip at docking time. Gaps of
+    at most gap ligands are left to ICM, not to split the intervals
+    """
+
+    # .dtb limit checked against each ligand property
+    limitProps = {"i_maxHdonor": "hDonors",
+                  "i_maxLigSize": "heavyAtoms",
+                  "i_maxNO": "nNO",
+                  "i_maxTorsion": "rotBonds"}
+
+    limits = {}
+    for keyword in limitProps.keys():
+        if dtbParams.get(keyword) is not None:
+            limits[keyword] = dtbParams.get(keyword)
+    props = vs_index.readProps(propsDir, [limitProps[keyword] for keyword in
+                                          limits.keys()])
+    checks = [(keyword, limit, props[limitProps[keyword]]) for
+              keyword, limit in limits.items()]
+    skipped = dict([(keyword, 0) for keyword in limits.keys()])
+
+    def keep(ligID):
+        for keyword, limit, propCol in checks:
+            # Ligands past the end of the sidecar are not filtered
+            if ligID <= len(propCol) and propCol[ligID - 1] > limit:
+                skipped[keyword] += 1
+                return False
+        return True
+
+    keptIntervals = filterIntervals(intervals, keep, gap)
+
+    ligCount = sum([upper - lower + 1 for lower, upper in intervals])
+    keptCount = sum([upper - lower + 1 for lower, upper in keptIntervals])
+    reportLines.append("PREFILTER:\n")
+    for keyword in sorted(limits.keys()):
+        reportLines.append("\t " + keyword + " > " + str(limits[keyword]) +
+                           " : " + str(skipped[keyword]) + " ligands over " +
+                           "the limit")
+    reportLines.append("\t " + str(ligCount - keptCount) + " ligands left " +
+                       "out, " + str(sum(skipped.values()) - ligCount +
+                                     keptCount) +
+                       " left to ICM in gaps of at most " + str(gap) +
+                       " ligands, " + str(len(keptIntervals)) + " intervals")
+
+    return keptIntervals, reportLines
+
+
+def filterDupes(intervals, dupPath, reportLines, gap=0):
+    """
+    Leave out of the ligand ID intervals the ligands listed as duplicates of
+    an other structure in the .dup report. Gaps of at most gap duplicates are
+    docked, not to split the intervals
+    """
+
+    dupes = vs_index.readDupes(dupPath)
+    found = [0]
+
+    def keep(ligID):
+        if ligID in dupes:
+            found[0] += 1
+            return False
+        return True
+
+    keptIntervals = filterIntervals(intervals, keep, gap)
+
+    ligCount = sum([upper - lower + 1 for lower, upper in intervals])
+    keptCount = sum([upper - lower + 1 for lower, upper in keptIntervals])
+    reportLines.append("DUPLICATES:\n")
+    reportLines.append("\t " + str(ligCount - keptCount) +
+                       " duplicate ligands left out, " +
+                       str(found[0] - ligCount + keptCount) +
+                       " docked in gaps of at most " + str(gap) +
+                       " ligands, " + str(len(keptIntervals)) + " intervals")
+
+    return keptIntervals, reportLines
+
+
+def filterIntervals(intervals, keep, gap=0):
+    """
+    Split the ligand ID intervals around the ligands for which keep(ligID) is
+    False, returning the intervals of the ligands kept. Gaps of at most gap
+    ligands within an interval do not split it
+    """
+
+    keptIntervals = []
+    for lower, upper in intervals:
+        pieces = []
+        intervalStart = None
+        for ligID in range(lower, upper + 1):
+            if keep(ligID):
+                if intervalStart is None:
+                    intervalStart = ligID
+            elif intervalStart is not None:
+                pieces.append([intervalStart, ligID - 1])
+                intervalStart = None
+        if intervalStart is not None:
+            pieces.append([intervalStart, upper])
+
+        for pieceLower, pieceUpper in pieces:
+            if keptIntervals and keptIntervals[-1][1] >= lower and \
+                    pieceLower - keptIntervals[-1][1] - 1 <= gap:
+                keptIntervals[-1][1] = pieceUpper
+            else:
+                keptIntervals.append([pieceLower, pieceUpper])
+
+    return keptIntervals
+
+
+def planSlices(intervals, sliceSize):
+    """
+    Cut the ligand ID intervals into slices of sliceSize ligands, each slice
+    being the list of [from, to] intervals it docks
+    """
+
+    slices = []
+    currSlice = []
+    ligCount = 0
+
+    for lower, upper in intervals:
+        while lower <= upper:
+            take = min(upper - lower + 1, sliceSize - ligCount)
+            currSlice.append([lower, lower + take - 1])
+            ligCount += take
+            lower += take
+            # This slice is full, start the next one
+            if ligCount == sliceSize:
+                slices.append(currSlice)
+                currSlice = []
+                ligCount = 0
+
+    if currSlice:
+        slices.append(currSlice)
+
+    return slices
+
+
+def planInterleavedSlices(intervals, sliceSize, chunkSize, stratify=False):
+    """
+    Cut the ligand ID intervals into chunks of chunkSize ligands, dealt to
+    as many slices as sliceSize gives in turn: slice i docks chunks i, i + n,
+    i + 2n... With stratify, the n chunks of each stratum are dealt in a
+    shuffled order, the same for every build
+    """
+
+    chunks = planSlices(intervals, chunkSize)
+    ligCount = sum([upper - lower + 1 for lower, upper in intervals])
+    sliceNum = max(1, int(math.ceil(ligCount / float(sliceSize))))
+    # Not more slices than chunks
+    sliceNum = min(sliceNum, len(chunks))
+
+    slices = [[] for sliceCount in range(sliceNum)]
+    order = list(range(sliceNum))
+    for chunkCount, chunk in enumerate(chunks):
+        stratum, position = divmod(chunkCount, sliceNum)
+        if stratify and position == 0:
+            order = list(range(sliceNum))
+            random.Random(stratum).shuffle(order)
+        slices[order[position]] += chunk
+
+    return slices
+
+
+def readCosts(costPath, ligFrom, ligTo):
+    """
+    Read the docking cost estimates of ligands ligFrom to ligTo, either
+    computed from a _props directory or read from a CSV of ligID,seconds.
+    Returns an array where item i holds the cost of ligand ID ligFrom + i,
+    -1 for ligands without an estimate
+    """
+
+    costs = array.array("d", [-1.]) * max(0, ligTo - ligFrom + 1)
+    if os.path.isdir(costPath):
+        props = vs_index.readProps(costPath, ["heavyAtoms", "rotBonds"],
+                                   ligFrom, ligTo)
+        for i, (heavyAtoms, rotBonds) in enumerate(zip(props["heavyAtoms"],
+                                                       props["rotBonds"])):
+            # Docking time grows with the ligand size and, more steeply,
+            # with its flexibility
+            costs[i] = heavyAtoms * (1 + rotBonds)
+    else:
+        with open(costPath) as costFile:
+            for row in csv.reader(costFile):
+                # Skip the header and empty lines
+                try:
+                    ligID = int(row[0])
+                    cost = float(row[1])
+                except (ValueError, IndexError):
+                    continue
+                if ligFrom <= ligID <= ligTo:
+                    costs[ligID - ligFrom] = cost
+
+    return costs
+
+
+def planCostSlices(intervals, sliceSize, costPath, reportLines):
+    """
+    Cut the ligand ID intervals into the number of slices sliceSize would
+    give, each with about the same predicted docking cost. Ligands without
+    an estimate are given the mean cost. The costs are read for the range of
+    the intervals only, and the cut points found from their running sum
+    """
+
+    ligFrom = min([lower for lower, upper in intervals] or [1])
+    ligTo = max([upper for lower, upper in intervals] or [0])
+    costs = readCosts(costPath, ligFrom, ligTo)
+
+    knownCost = 0.
+    knownCount = 0
+    for cost in costs:
+        if cost >= 0:
+            knownCost += cost
+            knownCount += 1
+    meanCost = knownCost / max(knownCount, 1) or 1.
+
+    # Ligands of the intervals, their total cost and those without estimate
+    ligCount = 0
+    totalCost = 0.
+    missing = 0
+    for lower, upper in intervals:
+        ligCount += upper - lower + 1
+        for ligID in range(lower, upper + 1):
+            cost = costs[ligID - ligFrom]
+            if cost < 0:
+                cost = meanCost
+                missing += 1
+            totalCost += cost
+    sliceNum = max(1, -(-ligCount // sliceSize))
+
+    # Close a slice once the running cost reaches its share of the total
+    slices = []
+    sliceCosts = []
+    currSlice = []
+    runningCost = 0.
+    for lower, upper in intervals:
+        segStart = lower
+        for ligID in range(lower, upper + 1):
+            cost = costs[ligID - ligFrom]
+            runningCost += cost if cost >= 0 else meanCost
+            if len(slices) < sliceNum - 1 and \
+                    runningCost >= totalCost * (len(slices) + 1) / sliceNum:
+                currSlice = addSegment(currSlice, segStart, ligID)
+                slices.append(currSlice)
+                sliceCosts.append(runningCost - sum(sliceCosts))
+                currSlice = []
+                segStart = ligID + 1
+        if segStart <= upper:
+            currSlice = addSegment(currSlice, segStart, upper)
+    if currSlice:
+        slices.append(currSlice)
+        sliceCosts.append(runningCost - sum(sliceCosts))
+
+    sliceCosts = sliceCosts or [0.]
+    reportLines.append("COST BALANCE:\n")
+    reportLines.append("\t " + str(len(slices)) + " slices, predicted cost " +
+                       "per slice: min " + str(round(min(sliceCosts), 1)) +
+                       ", max " + str(round(max(sliceCosts), 1)) +
+                       ", mean " + str(round(totalCost / sliceNum, 1)))
+    reportLines.append("\t " + str(missing) +
+                       " ligands without estimate, given the mean cost")
+
+    return slices, reportLines
+
+
+def addSegment(intervals, lower, upper):
+    """
+    Add the ligand ID segment lower-upper to the intervals of a slice,
+    extending the last interval when the segment follows it
+    """
+
+    if intervals and intervals[-1][1] == lower - 1:
+        intervals[-1][1] = upper
+    else:
+        intervals.append([lower, upper])
+
+    return intervals
+
+
+def writeSliceTable(repeatSlices, projName, workDir, reportLines,
+                    resume=False, interleave=None, stratify=False,
+                    sublibs=None):
+    """
+    Write the slice table of array jobs: one line per ligand interval of each
+    slice and repeat, giving the array task index, repeat, interval and .ou
+    output name, and with sublibs the sub-library of the slice and position
+    of the interval in it, the .ou output then being that of the slice. The
+    ordering of interleaved slices is noted in the header
+    """
+
+    tablePath = os.path.join(workDir, projName + "_slices.tsv")
+    with open(tablePath, "w") as table:
+        if interleave:
+            table.write("#order: interleaved chunks of " + str(interleave) +
+                        " ligands" + (", stratified" if stratify else "") +
+                        "\n")
+        table.write("#index\trepeat\tfrom\tto\toutput" +
+                    ("\tsublib\tlocalFrom\tlocalTo" if sublibs else "") +
+                    "\n")
+        for repeat, slices in enumerate(repeatSlices, 1):
+            for sliceCount, intervals in enumerate(slices, 1):
+                for (lower, upper), (localLower, localUpper) in \
+                        zip(intervals, localIntervals(intervals)):
+                    if sublibs:
+                        output = sublibOuName(projName, intervals, resume)
+                    else:
+                        output = ouName(projName, lower, upper, resume)
+                    fields = [str(sliceCount), str(repeat), str(lower),
+                              str(upper), output]
+                    if sublibs:
+                        fields += [sublibs[sliceKey(intervals)],
+                                   str(localLower), str(localUpper)]
+                    table.write("\t".join(fields) + "\n")
+
+    reportLines.append("SLICE TABLE:\n")
+    reportLines.append("\t " + os.path.basename(tablePath) + ": " +
+                       ", ".join([str(len(slices)) for slices in
+                                  repeatSlices]) + " slices per repeat")
+    reportLines.append("\n***********************\n")
 
     return reportLines
 
 
-def createSlices(libStart, libEnd, sliceSize, walltime, thor, projName,
-                 repeatNum, queue, reportLines, icmHome):
+def sliceKey(intervals):
+    """
+    Key of a slice in the sub-libraries, given its ligand intervals
+    """
+
+    return tuple([tuple(interval) for interval in intervals])
+
+
+def localIntervals(intervals):
+    """
+    Positions of the ligand intervals of a slice in its sub-library, which
+    holds them one after the other
+    """
+
+    localLower = 1
+    local = []
+    for lower, upper in intervals:
+        local.append([localLower, localLower + upper - lower])
+        localLower += upper - lower + 1
+
+    return local
+
+
+def sublibIDs(sublibPath):
+    """
+    Path of the list of library IDs of a sub-library
+    """
+
+    return os.path.splitext(sublibPath)[0] + ".ids"
+
+
+def writeSublibs(repeatSlices, idxPath, workDir, projName, reportLines):
+    """
+    Write the ligands of each slice to its own sub-library in sublib/, the
+    records of each interval being read at once from the offset the .idx
+    index gives, and their library IDs to the .ids list of the sub-library.
+    The index is streamed once, keeping only the span of each interval.
+    Repeats with the same slices share their sub-libraries. Returns the path
+    of the sub-library of each slice, by sliceKey
+    """
+
+    sdfPath = vs_index.indexSource(idxPath)
+
+    # Distinct slices, and the intervals they read
+    keys = []
+    for slices in repeatSlices:
+        for intervals in slices:
+            key = sliceKey(intervals)
+            if key not in keys:
+                keys.append(key)
+    needed = sorted(set([interval for key in keys for interval in key]))
+
+    # [offset, length, ligand count] of each interval, from the index rows
+    # of its ligands
+    spans = dict([(interval, [None, 0, 0]) for interval in needed])
+    active = []
+    nextInterval = 0
+    for ligID, offset, length, icmid in vs_index.readIndex(idxPath):
+        while nextInterval < len(needed) and \
+                needed[nextInterval][0] <= ligID:
+            active.append(needed[nextInterval])
+            nextInterval += 1
+        active = [interval for interval in active if interval[1] >= ligID]
+        if not active and nextInterval == len(needed):
+            break
+        for interval in active:
+            span = spans[interval]
+            if span[0] is None:
+                span[0] = offset
+            span[1] += length
+            span[2] += 1
+
+    for lower, upper in needed:
+        if spans[(lower, upper)][2] != upper - lower + 1:
+            print("Ligands " + str(lower) + " to " + str(upper) +
+                  " not found in " + idxPath)
+            sys.exit()
+
+    sublibDir = os.path.join(workDir, "sublib")
+    if not os.path.exists(sublibDir):
+        os.makedirs(sublibDir)
+
+    sublibs = {}
+    ligCount = 0
+    with open(sdfPath, "rb") as sdf:
+        for key in keys:
+            # Named after the slice bounds, and its intervals for the slices
+            # of a same range
+            sublibName = projName + "_" + str(key[0][0]) + "-" + \
+                str(key[-1][1]) + "_" + \
+                hashlib.sha1(str(key).encode()).hexdigest()[:8] + ".sdf"
+            sublibPath = os.path.join(sublibDir, sublibName)
+
+            # The records of an interval are contiguous in the library
+            with open(sublibPath, "wb") as sublib:
+                for interval in key:
+                    offset, length, count = spans[interval]
+                    for data in vs_index.readSpan(sdf, offset, length):
+                        sublib.write(data)
+                    ligCount += count
+
+            # Library ID of each ligand of the sub-library, in order
+            with open(sublibIDs(sublibPath), "w") as ids:
+                for lower, upper in key:
+                    for ligID in range(lower, upper + 1):
+                        ids.write(str(ligID) + "\n")
+
+            sublibs[key] = sublibPath
+
+    reportLines.append("SUB-LIBRARIES:\n")
+    reportLines.append("\t " + str(len(sublibs)) + " sub-libraries of " +
+                       str(ligCount) + " ligands from " +
+                       os.path.basename(sdfPath) + " in " +
+                       os.path.relpath(sublibDir))
+
+    return sublibs, reportLines
+
+
+def parseMemory(memory):
+    """
+    Convert a sacct memory value (e.g. 524288K, 1.5G) to MB
+    """
+
+    units = {"K": 1. / 1024, "M": 1., "G": 1024., "T": 1024. ** 2}
+    if not memory:
+        return 0.
+    if memory[-1] in units:
+        return float(memory[:-1]) * units[memory[-1]]
+
+    return float(memory) / 1024 ** 2
+
+
+def readHistory(historyDir, sacctPath, margin, reportLines):
+    """
+    Learn the throughput of a previous VS: core-seconds per ligand docked,
+    from the jobs of the sacct export over the SCORES> lines of its .ou
+    files, and peak memory of its jobs. Returns the seconds per ligand,
+    memory (MB, with the margin) and margin. The memory is requested by every
+    job of the VS, whatever its ligand count
+    """
+
+    # Number of ligands docked
+    ligCount = 0
+    for ouPath in glob.glob(historyDir + "/*/*.ou"):
+        with open(ouPath, "r") as ouFile:
+            ligCount += len([line for line in ouFile if "SCORES>" in line])
+
+    # Core-seconds of the jobs, their steps holding the memory use
+    coreSeconds = 0
+    peakMemory = 0.
+    with open(sacctPath, "r") as sacctFile:
+        rows = [line.rstrip("\n").split("|") for line in sacctFile
+                if line.strip()]
+    header = rows[0]
+    for row in rows[1:]:
+        row = dict(zip(header, row))
+        peakMemory = max(peakMemory, parseMemory(row.get("MaxRSS", "")))
+        if "." not in row["JobID"]:
+            coreSeconds += schedulers.parseWalltime(row["Elapsed"]) * \
+                int(row.get("AllocCPUS") or 1)
+
+    if ligCount == 0 or coreSeconds == 0:
+        print("No docked ligands or job run times found in " + historyDir +
+              " and " + sacctPath)
+        sys.exit()
+
+    secPerLig = float(coreSeconds) / ligCount
+    if peakMemory:
+        memory = int(math.ceil(peakMemory * margin / 128.)) * 128
+    else:
+        memory = 1024
+
+    reportLines.append("HISTORY:\n")
+    reportLines.append("\t " + str(ligCount) + " ligands docked in " +
+                       str(coreSeconds) + " core-seconds: " +
+                       str(round(secPerLig, 2)) + " s per ligand")
+    reportLines.append("\t peak memory " + str(int(peakMemory)) +
+                       " MB, requesting " + str(memory) + " MB")
+
+    return (secPerLig, memory, margin), reportLines
+
+
+def sliceWalltime(intervals, sizing, walltime):
+    """
+    Walltime of a slice given the throughput learnt by readHistory, with
+    the margin, at least 10 minutes and at most the walltime given. Without
+    sizing the walltime given is used
+    """
+
+    if not sizing:
+        return walltime
+
+    secPerLig, memory, margin = sizing
+    ligCount = sum([upper - lower + 1 for lower, upper in intervals])
+    seconds = max(600, ligCount * secPerLig * margin)
+
+    return schedulers.formatWalltime(
+        min(seconds, schedulers.parseWalltime(walltime)))
+
+
+def createSlices(repeatSlices, libStart, libEnd, walltime, thor, projName,
+                 queue, reportLines, icmHome, arrayJobs=False, throttle=None,
+                 resume=False, checkpoint=False, workers=None, sizing=None,
+                 sublibs=None, setupNames=None, tmpdir=False):
     """
     Create the .slurm slices to split the VS job into portions for submission
-    to the cluster
+    to the cluster, given the slices of each repeat. In array mode a single
+    array script per repeat covers all slices. With sizing, the walltime and
+    memory of each job are those learnt from a previous VS. With sublibs,
+    each slice docks its sub-library from a staging directory linking the
+    setupNames files of the repeat
     """
 
+    memory = 1024
+    if sizing:
+        memory = sizing[1]
+
     repeat = 1
+    repeatNum = len(repeatSlices)
 
     # Loop over repeat directories
     while repeat <= repeatNum:
 
+        slices = repeatSlices[repeat - 1]
+
         # Initialize variables for this repeat
         cwd = os.getcwd()
         repeatDir = cwd + "/" + str(repeat) + "/"
@@ -263,22 +1463,37 @@ def createSlices(libStart, libEnd, sliceSize, walltime, thor, projName,
         reportLines.append("\n")
         reportLines.append("REPEAT:" + repeatDir + "\n")
 
-        # Initialize variables for the first slice
-        lowerLimit = libStart
-        upperLimit = libStart + sliceSize - 1
-        sliceCount = 1
-        keepLooping = True
+        # Walltime of each slice
+        sliceTimes = [sliceWalltime(intervals, sizing, walltime) for
+                      intervals in slices]
+
+        # One array job for all slices of this repeat, given the longest
+        # walltime
+        if arrayJobs:
+            if slices:
+                arrayTime = walltime
+                if sizing:
+                    arrayTime = schedulers.formatWalltime(
+                        max([schedulers.parseWalltime(sliceTime)
+                             for sliceTime in sliceTimes]))
+                reportLines = arraySlice(arrayTime, projName, thor,
+                                         len(slices), throttle, repeat,
+                                         repeatDir, queue, reportLines,
+                                         icmHome, checkpoint, memory,
+                                         bool(sublibs), setupNames, tmpdir)
+            repeat += 1
+            continue
 
         # Loop over the slices
-        while keepLooping:
+        for sliceCount, intervals in enumerate(slices, 1):
 
-            # Exit statement of the loop, when upperLimit has reached the
-            # size of the ligand library
-            if upperLimit >= libEnd:
-                upperLimit = libEnd
-                # Once the end of the libSize has been reached, stop the next
-                # loop
-                keepLooping = False
+            # Slices are named after the last ligand they dock
+            upperLimit = intervals[-1][1]
+
+            # Sub-library of the slice, if any
+            sublib = None
+            if sublibs:
+                sublib = sublibs[sliceKey(intervals)]
 
             # Create sliceName for job name and slurm file name
             sliceName = projName + "_rep" + str(repeat) + \
@@ -288,63 +1503,484 @@ def createSlices(libStart, libEnd, sliceSize, walltime, thor, projName,
             # command
             if queue == "slurm-srun":
                 reportLines = slurmSrunSlice(sliceCount, projName, thor,
-                                             lowerLimit, upperLimit,
-                                             libStart, libEnd,
-                                             repeatDir, reportLines, icmHome)
+                                             intervals, libStart, libEnd,
+                                             repeatDir, reportLines, icmHome,
+                                             resume, checkpoint, sublib,
+                                             setupNames, tmpdir)
             elif queue == "sge":
-                reportLines = sgeSlice(walltime, sliceName, projName, thor,
-                                       lowerLimit, upperLimit, repeatDir,
-                                       reportLines, icmHome)
+                reportLines = sgeSlice(sliceTimes[sliceCount - 1], sliceName,
+                                       projName, thor, intervals, repeatDir,
+                                       reportLines, icmHome, resume,
+                                       checkpoint, memory, sublib,
+                                       setupNames, tmpdir)
             elif queue == "slurm":
-                reportLines = slurmSlice(walltime, sliceName, projName, thor,
-                                         lowerLimit, upperLimit, repeatDir,
-                                         reportLines, icmHome)
-
-            # Update upperLimit and sliceCount
-            lowerLimit += sliceSize
-            upperLimit += sliceSize
-            sliceCount += 1
+                reportLines = slurmSlice(sliceTimes[sliceCount - 1],
+                                         sliceName, projName, thor, intervals,
+                                         repeatDir, reportLines, icmHome,
+                                         resume, checkpoint, memory, sublib,
+                                         setupNames, tmpdir)
+            elif queue == "local":
+                reportLines = localSlice(sliceName, projName, thor, intervals,
+                                         repeatDir, reportLines, icmHome,
+                                         resume, checkpoint, sublib,
+                                         setupNames, tmpdir)
 
         # Update the repeat number
         repeat += 1
 
-        # Combine these slices in a call srun
-        if queue == "slurm-srun":
-            slurmSrun(projName, libStart, libEnd, walltime,
-                      repeatDir, repeat, sliceCount - 1)
+        # Combine these slices in a call srun, lasting as long as its longest
+        # slice, or as its workers take to go through all slices
+        if queue == "slurm-srun" and slices:
+            srunTime = walltime
+            if sizing:
+                seconds = [schedulers.parseWalltime(sliceTime)
+                           for sliceTime in sliceTimes]
+                if workers:
+                    seconds.append(sum(seconds) / float(workers))
+                srunTime = schedulers.formatWalltime(
+                    min(max(seconds), schedulers.parseWalltime(walltime)))
+            slurmSrun(projName, libStart, libEnd, srunTime,
+                      repeatDir, repeat, len(slices), checkpoint, workers,
+                      memory)
 
     return reportLines
 
 
-def slurmSrun(projName, libStart, libEnd,  walltime, repeatDir, repeat, sliceCount):
+def writeManifest(repeatSlices, libStart, libEnd, thor, projName, queue,
+                  setupDir, workDir, reportLines, arrayJobs=False,
+                  resume=False, checkpoint=False, stage=None, sublibs=None,
+                  setupDigests=None):
     """
-    Create the srun SLURM script which will group all SLURM submissions together
+    Write vs_manifest.json, listing the job scripts of this build and, for
+    each repeat, its slices with their ligand ID intervals and expected .ou
+    and .ob answers files. With sublibs, the intervals also give their
+    sub-library and the offset of its ligand IDs (as named in the answers)
+    to the library IDs, the .ou and answers files being those of the slice,
+    docked in a single call. The repeats not rebuilt (resumed, or of previous
+    stages) keep the slices of the previous manifest, resumed repeats also
+    get the new ones. The setup files are hashed unless setupDigests, from
+    the store, already gives their SHA-1
     """
 
-    slurmName = projName + "_" + str(repeat)
+    manifestPath = os.path.join(workDir, manifest.MANIFEST)
+    repeats = {}
+    if (resume or stage) and os.path.exists(manifestPath):
+        with open(manifestPath, "r") as manifestFile:
+            repeats = json.load(manifestFile)["repeats"]
 
+    jobs = []
     libRange = str(libStart) + "-" + str(libEnd)
+    for repeat, slices in enumerate(repeatSlices, 1):
+        repeat = str(repeat)
+        if not slices:
+            continue
+
+        # Job scripts as named by createSlices
+        repeatJobs = []
+        if arrayJobs:
+            repeatJobs.append(projName + "_rep" + repeat + "." + queue)
+        elif queue == "slurm-srun":
+            repeatJobs.append("srun_" + libRange + ".slurm")
+
+        sliceInfos = []
+        for sliceCount, intervals in enumerate(slices, 1):
+            sliceInfo = {}
+            if arrayJobs:
+                sliceInfo["script"] = repeatJobs[0]
+                sliceInfo["task"] = sliceCount
+            elif queue == "slurm-srun":
+                sliceInfo["script"] = "slice_" + libRange + "_" + \
+                    str(sliceCount) + ".sh"
+            else:
+                sliceInfo["script"] = projName + "_rep" + repeat + "_sl" + \
+                    str(intervals[-1][1]) + "." + queue
+                repeatJobs.append(sliceInfo["script"])
+            sliceInfo["intervals"] = [
+                {"from": lower, "to": upper,
+                 "output": ouName(projName, lower, upper, resume),
+                 "answers": projName + "_answers" + str(lower) + ".ob"}
+                for lower, upper in intervals]
+            if sublibs:
+                sublib = os.path.relpath(sublibs[sliceKey(intervals)],
+                                         workDir)
+                for interval, (localLower, localUpper) in \
+                        zip(sliceInfo["intervals"], localIntervals(intervals)):
+                    interval["sublib"] = sublib
+                    interval["idOffset"] = interval["from"] - localLower
+                    interval["output"] = sublibOuName(projName, intervals,
+                                                      resume)
+                    interval["answers"] = projName + "_answers" + \
+                        str(intervals[0][0]) + ".ob"
+            sliceInfos.append(sliceInfo)
+
+        if resume and repeat in repeats:
+            sliceInfos = repeats[repeat]["slices"] + sliceInfos
+        repeats[repeat] = {"thoroughness": thor, "checkpoint": checkpoint,
+                           "slices": sliceInfos}
+        jobs += [repeat + "/" + job for job in repeatJobs]
+
+    # A repeat without new slices keeps those of the previous manifest. When
+    # it was built without one, the other tools list the VS directory instead
+    for repeat in range(1, len(repeatSlices) + 1):
+        if str(repeat) not in repeats:
+            if resume or stage:
+                if os.path.exists(manifestPath):
+                    os.remove(manifestPath)
+                reportLines.append("MANIFEST:\n")
+                reportLines.append("\t not written, repeat " + str(repeat) +
+                                   " was built without a manifest")
+                return reportLines
+            repeats[str(repeat)] = {"thoroughness": thor,
+                                    "checkpoint": checkpoint, "slices": []}
+
+    setup = setupDigests
+    if setup is None:
+        setup = dict([(os.path.basename(filePath), fileSha1(filePath))
+                      for filePath in sorted(glob.glob(setupDir + "/*"))])
+
+    data = {"project": projName,
+            "queue": queue,
+            "created": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "libStart": libStart,
+            "libEnd": libEnd,
+            "setup": setup,
+            "jobs": jobs,
+            "repeats": repeats}
+
+    # Written to a temporary file renamed over the previous manifest
+    tempFd, tempPath = tempfile.mkstemp(prefix="tmp_", suffix=".json",
+                                        dir=workDir)
+    with os.fdopen(tempFd, "w") as tempFile:
+        json.dump(data, tempFile, indent=1, sort_keys=True)
+    os.chmod(tempPath, 0o644)
+    os.rename(tempPath, manifestPath)
+
+    reportLines.append("MANIFEST:\n")
+    reportLines.append("\t " + manifest.MANIFEST + ": " + str(len(jobs)) +
+                       " job scripts, " +
+                       str(sum([len(repeats[repeat]["slices"])
+                                for repeat in repeats])) + " slices")
+
+    return reportLines
+
+
+def ouName(projName, lower, upper, resume=False):
+    """
+    Name of the .ou output of a ligand interval. Resumed intervals are named
+    after both bounds, not to overwrite the results of the previous run
+    """
+
+    if resume:
+        return projName + "_" + str(lower) + "-" + str(upper) + ".ou"
+    else:
+        return projName + "_" + str(upper) + ".ou"
+
+
+def sublibOuName(projName, intervals, resume=False):
+    """
+    Name of the .ou output of a slice docked from its sub-library, in a
+    single ICM call: that of an interval spanning the slice
+    """
+
+    return ouName(projName, intervals[0][0], intervals[-1][1], resume)
+
+
+def dockLines(projName, thor, intervals, output=None, resume=False,
+              checkpoint=False, sublib=None, setupNames=None, tmpdir=False):
+    """
+    ICM docking command lines for the ligand intervals of a slice, one call
+    per interval, each writing its own .ou (and .sdf if output is given).
+    With checkpoint, the intervals are docked by the dock function of
+    checkpointLines. With a sublib, holding the ligands of all intervals,
+    the slice is docked by a single call in the staging directory of
+    stageLines
+    """
+
+    if sublib:
+        return sublibDockLines(projName, thor, intervals, sublib, setupNames,
+                               tmpdir, output, resume)
 
     lines = []
-    lines.append("#!/bin/bash")
-    lines.append("#SBATCH --ntasks=" + str(sliceCount))
-    lines.append("#SBATCH --mem-per-cpu=1024")
-    lines.append("#SBATCH --time=" + walltime)
-    lines.append("#SBATCH --job-name=" + slurmName)
+    if checkpoint:
+        lines += checkpointLines(projName, thor)
+
+    for lower, upper in intervals:
+        ou = ouName(projName, lower, upper, resume)
+
+        # Slices of several intervals get one output file per interval,
+        # resumed ones are named after both bounds
+        sdf = None
+        if output:
+            if resume:
+                sdf = output + "_" + str(lower) + "-" + str(upper)
+            elif len(intervals) > 1:
+                sdf = output + "_" + str(upper)
+            else:
+                sdf = output
+
+        if checkpoint:
+            line = "dock " + str(lower) + " " + str(upper) + " " + \
+                ou.replace(".ou", "")
+            if sdf:
+                line += " " + sdf
+        else:
+            line = "$ICMHOME/icm64 -vlscluster $ICMHOME/_dockScan " + \
+                projName + " thorough=" + thor
+            if sdf:
+                line += " -a"
+            line += " from=" + str(lower) + \
+                " to=" + str(upper)
+            if sdf:
+                line += " output=" + sdf + ".sdf"
+            line += " >& " + ou
+        lines.append(line)
+
+    return lines
+
+
+def sublibDockLines(projName, thor, intervals, sublib, setupNames, tmpdir,
+                    output=None, resume=False):
+    """
+    ICM docking command lines for a slice docked from its sub-library: a
+    single call for all its ligands, in the staging directory of stageLines,
+    writing one .ou (and .sdf if output is given)
+    """
+
+    lower = intervals[0][0]
+    upper = intervals[-1][1]
+    ligCount = sum([intUpper - intLower + 1
+                    for intLower, intUpper in intervals])
+    ou = sublibOuName(projName, intervals, resume)
+
+    sdf = None
+    if output:
+        if resume:
+            sdf = output + "_" + str(lower) + "-" + str(upper)
+        else:
+            sdf = output
+
+    lines = stageLines(setupNames, tmpdir, sublib)
+    line = "(cd $STAGE && $ICMHOME/icm64 -vlscluster $ICMHOME/_dockScan " + \
+        projName + " thorough=" + thor
+    if sdf:
+        line += " -a"
+    line += " input=$SUBLIB from=1 to=" + str(ligCount)
+    if sdf:
+        line += " output=" + sdf + ".sdf"
+    line += " < /dev/null > " + ou + " 2>&1)"
+    lines.append(line)
+    lines += unstageLines(projName, ou, sublibIDs(sublib), str(lower), sdf)
+    lines.append("rm -rf $STAGE")
+
+    return lines
+
+
+def stageLines(setupNames, tmpdir, sublib=None):
+    """
+    Shell lines creating the staging directory ICM docks a sub-library in,
+    linking the setup files of the repeat: in the repeat directory, or on
+    the node-local $TMPDIR, the sublib then being copied there
+    """
+
+    lines = []
+    lines.append("")
+    lines.append("# Dock the sub-library of the slice in a staging directory")
+    if tmpdir:
+        lines.append("STAGE=`mktemp -d ${TMPDIR:-/tmp}/vs_XXXXXX` || exit 1")
+    else:
+        lines.append("STAGE=`mktemp -d $PWD/stage_XXXXXX` || exit 1")
+    lines.append("for f in " + " ".join(setupNames) +
+                 "; do ln -s $PWD/$f $STAGE/$f; done")
+    if sublib and tmpdir:
+        lines.append("cp " + sublib + " $STAGE/")
+        lines.append("SUBLIB=" + os.path.basename(sublib))
+    elif sublib:
+        lines.append("SUBLIB=" + sublib)
+    lines.append("")
+
+    return lines
+
+
+def unstageLines(projName, ou, ids, lower, sdf=None):
+    """
+    Shell lines moving the results of a slice docked from a sub-library out
+    of the staging directory: the ligand IDs of the SCORES> lines, positions
+    in the sub-library, are replaced by the library IDs listed in ids, and
+    the answers file renamed after the first library ID of the slice.
+    Arguments are strings, shell variables in array scripts
+    """
+
+    lines = []
+    lines.append("awk 'NR == FNR {id[FNR] = $1; next} " +
+                 "$1 == \"SCORES>\" {$3 = id[$3]} {print}' " + ids +
+                 " $STAGE/" + ou + " > " + ou)
+    lines.append("mv $STAGE/" + projName + "_answers1.ob " +
+                 projName + "_answers" + lower + ".ob 2>/dev/null")
+    if sdf:
+        lines.append("mv $STAGE/" + sdf + ".sdf " + sdf + ".sdf")
+
+    return lines
+
+
+def checkpointLines(projName, thor):
+    """
+    Shell function docking the ligands from $1 to $2 into $3.ou (and $4.sdf
+    if given). A previous run of the job having docked part of them, it
+    restarts after the last ligand with a SCORES> line and writes the next
+    _p<N> part file instead
+    """
+
+    lines = []
+    lines.append("")
+    lines.append("# Restart after the last ligand docked by a previous run, "
+                 "in a new part file")
+    lines.append("dock() {")
+    lines.append("\tfrom=$1")
+    lines.append("\tlast=`cat $3.ou $3_p*.ou 2>/dev/null | " +
+                 "awk '$1 == \"SCORES>\" {print $3}' | sort -n | tail -1`")
+    lines.append("\tif [ -n \"$last\" ]; then from=$((last + 1)); fi")
+    lines.append("\tif [ $from -gt $2 ]; then return; fi")
+    lines.append("\tpart=\"\"")
+    lines.append("\tn=0")
+    lines.append("\twhile [ -e $3$part.ou ]; do n=$((n + 1)); part=_p$n; done")
+    lines.append("\tif [ -n \"$4\" ]; then")
+    lines.append("\t\t$ICMHOME/icm64 -vlscluster $ICMHOME/_dockScan " +
+                 projName + " thorough=" + thor + " -a from=$from to=$2 " +
+                 "output=$4$part.sdf < /dev/null > $3$part.ou 2>&1")
+    lines.append("\telse")
+    lines.append("\t\t$ICMHOME/icm64 -vlscluster $ICMHOME/_dockScan " +
+                 projName + " thorough=" + thor + " from=$from to=$2 " +
+                 "< /dev/null > $3$part.ou 2>&1")
+    lines.append("\tfi")
+    lines.append("}")
     lines.append("")
-    lines.append("for i in `seq 1 $SLURM_NTASKS`")
+
+    return lines
+
+
+def arraySlice(walltime, projName, thor, sliceNum, throttle, repeat,
+               repeatDir, queue, reportLines, icmHome, checkpoint=False,
+               memory=1024, sublib=False, setupNames=None, tmpdir=False):
+    """
+    Create the SLURM or SGE array script of a repeat. Each task docks the
+    ligand intervals listed for its index and repeat in the slice table, or
+    if sublib the sub-library listed with them, in a single ICM call
+    """
+
+    sliceName = projName + "_rep" + str(repeat)
+    taskRange = "1-" + str(sliceNum)
+
+    backend = schedulers.getScheduler(queue)
+    lines = backend.header(sliceName, walltime, memory, checkpoint,
+                           tasks=taskRange, throttle=throttle)
+    taskID = backend.taskID
+    if queue == "slurm" and throttle:
+        taskRange += "%" + str(throttle)
+    lines.append("")
+    lines.append("ICMHOME=" + icmHome)
+    if checkpoint:
+        lines += checkpointLines(projName, thor)
+    if sublib:
+        lines += stageLines(setupNames, tmpdir)
+        # The intervals of the task are all in its sub-library, from the first
+        # library ID, to the last position
+        lines.append("awk -v task=" + taskID + " -v repeat=" + str(repeat) +
+                     " '$1 == task && $2 == repeat " +
+                     "{if (!n++) {from = $3; output = $5; sublib = $6}; " +
+                     "to = $8} END {if (n) print from, output, sublib, to}' " +
+                     "../" + projName + "_slices.tsv |")
+        lines.append("while read from output sublib localTo")
+    else:
+        lines.append("awk -v task=" + taskID + " -v repeat=" +
+                     str(repeat) + " '$1 == task && $2 == repeat " +
+                     "{print $3, $4, $5}' ../" + projName + "_slices.tsv |")
+        lines.append("while read from to output")
     lines.append("do")
-    lines.append('\tsrun --nodes=1 --ntasks=1 --cpus-per-task=1 ' +
-                 'sh -c "(sh slice_' + libRange + '_$i.sh)" &')
+    if sublib:
+        lines.append("\tids=${sublib%.sdf}.ids")
+        if tmpdir:
+            lines.append("\t[ -e $STAGE/${sublib##*/} ] || cp $sublib $STAGE/")
+            lines.append("\tsublib=${sublib##*/}")
+        lines.append("\t(cd $STAGE && $ICMHOME/icm64 -vlscluster " +
+                     "$ICMHOME/_dockScan " + projName + " thorough=" + thor +
+                     " input=$sublib from=1 to=$localTo " +
+                     "< /dev/null > $output 2>&1)")
+        lines += ["\t" + line for line in
+                  unstageLines(projName, "$output", "$ids", "$from")]
+    elif checkpoint:
+        lines.append("\tdock $from $to ${output%.ou}")
+    else:
+        lines.append("\t$ICMHOME/icm64 -vlscluster $ICMHOME/_dockScan " +
+                     projName + " thorough=" + thor +
+                     " from=$from to=$to < /dev/null > $output 2>&1")
     lines.append("done")
-    lines.append("wait")
+    if sublib:
+        lines.append("rm -rf $STAGE")
+
+    # WRITE ARRAY LINES TO FILE
+    with open(repeatDir + sliceName + "." + queue, "w") as f:
+        f.write("\n".join(lines))
+
+    # Update report
+    reportLines.append("\t ARRAY:" + sliceName + "." + queue + ", tasks " +
+                       taskRange)
+
+    return reportLines
+
+
+def slurmSrun(projName, libStart, libEnd,  walltime, repeatDir, repeat, sliceCount,
+              checkpoint=False, workers=None, memory=1024):
+    """
+    Create the srun SLURM script which will group all SLURM submissions together.
+    With workers, that many vs_worker.py tasks pull the slices from a queue
+    file filled when the allocation starts
+    """
+
+    slurmName = projName + "_" + str(repeat)
+
+    libRange = str(libStart) + "-" + str(libEnd)
+
+    ntasks = sliceCount
+    if workers:
+        ntasks = min(workers, sliceCount)
+    lines = schedulers.getScheduler("slurm").header(slurmName, walltime,
+                                                    memory, checkpoint,
+                                                    ntasks=ntasks)
+    lines.append("")
+    if workers:
+        queueName = "srun_" + libRange + ".queue"
+        workerPath = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                  "vs_worker.py")
+        lines.append("# Queue of the slices, pulled by the workers until it "
+                     "is empty")
+        lines.append("for i in `seq 1 " + str(sliceCount) + "`")
+        lines.append("do")
+        lines.append("\techo slice_" + libRange + "_$i.sh")
+        lines.append("done > " + queueName)
+        lines.append("")
+        lines.append("for i in `seq 1 $SLURM_NTASKS`")
+        lines.append("do")
+        lines.append('\tsrun --nodes=1 --ntasks=1 --cpus-per-task=1 ' +
+                     sys.executable + " " + workerPath + " " + queueName +
+                     " &")
+        lines.append("done")
+        lines.append("wait")
+    else:
+        lines.append("for i in `seq 1 $SLURM_NTASKS`")
+        lines.append("do")
+        lines.append('\tsrun --nodes=1 --ntasks=1 --cpus-per-task=1 ' +
+                     'sh -c "(sh slice_' + libRange + '_$i.sh)" &')
+        lines.append("done")
+        lines.append("wait")
 
     with open(repeatDir + "srun_" + libRange  + ".slurm", "w") as f:
         f.write("\n".join(lines))
 
 
-def slurmSrunSlice(sliceCount, projName, thor, lowerLimit, upperLimit,
-                   libStart, libEnd, repeatDir, reportLines, icmHome):
+def slurmSrunSlice(sliceCount, projName, thor, intervals, libStart, libEnd,
+                   repeatDir, reportLines, icmHome, resume=False,
+                   checkpoint=False, sublib=None, setupNames=None,
+                   tmpdir=False):
     """
     Create a slurm slice that will be used as part of a bundled SRUN command
     and write to a file with the info provided
@@ -354,13 +1990,10 @@ def slurmSrunSlice(sliceCount, projName, thor, lowerLimit, upperLimit,
     lines.append("#!/bin/bash")
     lines.append("")
     lines.append("ICMHOME=" + icmHome)
-    lines.append("$ICMHOME/icm64 -vlscluster $ICMHOME/_dockScan " + projName +
-                 " thorough=" + thor +
-                 " -a" +
-                 " from=" + str(lowerLimit) +
-                 " to=" + str(upperLimit) +
-                 " output=" + projName + "_" + str(sliceCount) + ".sdf" +
-                 " >& " + projName + "_" + str(upperLimit) + ".ou")
+    lines += dockLines(projName, thor, intervals,
+                       output=projName + "_" + str(sliceCount), resume=resume,
+                       checkpoint=checkpoint, sublib=sublib,
+                       setupNames=setupNames, tmpdir=tmpdir)
 
     # WRITE SLURM LINES TO FILE
     sliceName = str(libStart) + "-" + str(libEnd) + "_" + str(sliceCount)
@@ -375,24 +2008,20 @@ def slurmSrunSlice(sliceCount, projName, thor, lowerLimit, upperLimit,
     return reportLines
 
 
-def slurmSlice(walltime, sliceName, projName, thor, lowerLimit, upperLimit,
-               repeatDir, reportLines, icmHome):
+def slurmSlice(walltime, sliceName, projName, thor, intervals, repeatDir,
+               reportLines, icmHome, resume=False, checkpoint=False,
+               memory=1024, sublib=None, setupNames=None, tmpdir=False):
     """
     Create a slurm slice and write to a file with the info provided
     """
 
-    lines = []
-    lines.append("#!/bin/bash")
-    lines.append("#SBATCH --mem=1024")
-    lines.append("#SBATCH --time=" + walltime)
-    lines.append("#SBATCH --job-name=" + sliceName)
+    lines = schedulers.getScheduler("slurm").header(sliceName, walltime,
+                                                    memory, checkpoint)
     lines.append("")
     lines.append("ICMHOME=" + icmHome)
-    lines.append("$ICMHOME/icm64 -vlscluster $ICMHOME/_dockScan " + projName +
-                 " thorough=" + thor +
-                 " from=" + str(lowerLimit) +
-                 " to=" + str(upperLimit) +
-                 " >& " + projName + "_" + str(upperLimit) + ".ou")
+    lines += dockLines(projName, thor, intervals, resume=resume,
+                       checkpoint=checkpoint, sublib=sublib,
+                       setupNames=setupNames, tmpdir=tmpdir)
 
     # WRITE SLURM LINES TO FILE
     with open(repeatDir + sliceName + ".slurm", "w") as f:
@@ -406,27 +2035,49 @@ def slurmSlice(walltime, sliceName, projName, thor, lowerLimit, upperLimit,
     return reportLines
 
 
-def sgeSlice(walltime, sliceName, projName, thor, lowerLimit, upperLimit,
-             repeatDir, reportLines, icmHome):
+def localSlice(sliceName, projName, thor, intervals, repeatDir, reportLines,
+               icmHome, resume=False, checkpoint=False, sublib=None,
+               setupNames=None, tmpdir=False):
+    """
+    Create a slice run on the current machine by vs_submit.py. ICMHOME and
+    the docking executable (ICMEXEC, $ICMHOME/icm64 by default) can be
+    overridden from the environment
+    """
+
+    lines = schedulers.getScheduler("local").header(sliceName)
+    lines.append("")
+    lines.append("ICMHOME=${ICMHOME:-" + icmHome + "}")
+    lines.append("ICMEXEC=${ICMEXEC:-$ICMHOME/icm64}")
+    lines += [line.replace("$ICMHOME/icm64", "$ICMEXEC") for line in
+              dockLines(projName, thor, intervals, resume=resume,
+                        checkpoint=checkpoint, sublib=sublib,
+                        setupNames=setupNames, tmpdir=tmpdir)]
+
+    # WRITE LOCAL LINES TO FILE
+    with open(repeatDir + sliceName + ".local", "w") as f:
+        f.write("\n".join(lines))
+
+    # Update report
+    reportLines.append("\tproject: " + projName +
+                       ", repeat:" + os.path.relpath(repeatDir) +
+                       ", slice:" + sliceName)
+
+    return reportLines
+
+
+def sgeSlice(walltime, sliceName, projName, thor, intervals, repeatDir,
+             reportLines, icmHome, resume=False, checkpoint=False,
+             memory=1024, sublib=None, setupNames=None, tmpdir=False):
     """
     Create a SGE slice given the info provided
     """
-    lines = []
-    lines.append("#!/bin/sh")
-    lines.append("#$ -S /bin/sh")
-    lines.append("#$ -l h_rt=" + walltime)
-    lines.append("#$ -l h_vmem=1G")
-    lines.append("#$ -q hqu9")
-    lines.append("#$ -l dpod=1")
-    lines.append("#$ -cwd")
-    lines.append("#$ -N " + str(sliceName))
+    lines = schedulers.getScheduler("sge").header(sliceName, walltime, memory,
+                                                  checkpoint)
     lines.append("")
     lines.append("ICMHOME=" + icmHome)
-    lines.append("$ICMHOME/icm64 -vlscluster $ICMHOME/_dockScan " + projName +
-                 " thorough=" + thor +
-                 " from=" + str(lowerLimit) +
-                 " to=" + str(upperLimit) +
-                 " >& " + projName + "_" + str(upperLimit) + ".ou")
+    lines += dockLines(projName, thor, intervals, resume=resume,
+                       checkpoint=checkpoint, sublib=sublib,
+                       setupNames=setupNames, tmpdir=tmpdir)
 
     # WRITE SLURM LINES TO FILE
     with open(repeatDir + sliceName + ".sge", "w") as f:
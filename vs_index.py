@@ -6,34 +6,105 @@
 # name but with the .inx extension. It can then be moved to
 # the VS directory.
 # An .icm script is created temporarly, modified and exectuted, then deleted.
+# Several libraries (listed, or matching quoted globs) and cluster suffixes
+# (comma separated) are indexed by a single ICM session, or split across
+# --nproc concurrent ICM processes, each running its own temporary script.
+# With -native the .sdf is instead indexed without ICM: it is streamed once
+# through a memory map and a record-offset index (.idx) is written, listing
+# the ligand ID, byte offset, length and ICMID field of each record.
+# Large libraries can be split into byte ranges scanned in parallel (--nproc).
+# Block-compressed libraries (BGZF, as written by bgzip) are indexed without
+# being inflated to disk: each ligand is located by the offset of its
+# compressed block and its offset within that block. --extract uses the index
+# to pull a ligand ID range out of either kind of library.
+# Re-running -native on a library that was only appended to since it was
+# indexed scans the appended records only (-rebuild forces a full scan).
+# With -props the same pass computes cheap per-ligand properties (heavy
+# atoms, rotatable bonds, H-bond donors, N+O count) into a columnar sidecar
+# that vs_build.py uses to drop ligands ICM would skip at docking time.
+# Indexing without -props removes the _props sidecar of a previous index.
+# With -dedup each record's connection table (atom and bond blocks, without
+# coordinates) is hashed into a .hash index, and a .dup report maps every
+# duplicate ligand ID to the first ID of that structure. Indexing without
+# -dedup removes the .hash and .dup files of a previous index.
 #
 # https://github.com/thomas-coudrat/toolbx_vs
 # Thomas Coudrat <thomas.coudrat@gmail.com>
 
 import argparse
+import array
+import glob
+import hashlib
+import itertools
+import mmap
+import multiprocessing
 import os
+import struct
+import shutil
 import sys
-from subprocess import check_output, STDOUT, CalledProcessError
+import tempfile
+import zlib
+from subprocess import Popen, PIPE, STDOUT
 import socket
 import json
 
+# Target size of the byte ranges scanned by each worker of a parallel index
+CHUNK_BYTES = 64 * 1024 * 1024
+
+# BGZF block header: gzip magic, deflate, FEXTRA flag set
+BGZF_MAGIC = b"\x1f\x8b\x08\x04"
+
+# Ligand properties of the -props sidecar, one uint16 column file each
+PROP_COLUMNS = ["heavyAtoms", "rotBonds", "hDonors", "nNO"]
+
+# Default valence of the atoms that can be H-bond donors, used to count
+# implicit hydrogens
+DONOR_VALENCE = {"N": 3, "O": 2}
+
+# Atom block charge codes of the molfile format
+CHARGE_CODES = {1: 3, 2: 2, 3: 1, 5: -1, 6: -2, 7: -3}
+
 
 def main():
     """
     Run script
     """
 
+    # Extract the arguments
+    sdfFiles, suffixes, native, nproc, extract, rebuild, props, \
+        dedup = parseArgs()
+
+    # Every library is indexed for every suffix
+    pairs = [(sdfFile, suffix) for sdfFile in sdfFiles for suffix in suffixes]
+
+    # Write a ligand ID range of the library to its own .sdf
+    if extract:
+        ligFrom, ligTo = extract
+        for sdfFile, suffix in pairs:
+            outPath = indexPath(sdfFile, suffix, "_" + str(ligFrom) + "-" +
+                                str(ligTo) + ".sdf")
+            extractRange(sdfFile, indexPath(sdfFile, suffix, ".idx"),
+                         ligFrom, ligTo, outPath)
+            print("\nWritten: \t" + outPath + "\n")
+        return
+
+    # Index the .sdf in Python, no ICM needed
+    if native:
+        for sdfFile, suffix in pairs:
+            nativeIndex(sdfFile, suffix, nproc, rebuild, props, dedup)
+        return
+
     # Get the path from the Json file
     icm = getPath()
 
-    # Extract the arguments
-    sdfFile, suffix = parseArgs()
-
-    # Generate the ICM script
-    scriptPath = generateScript(icm, sdfFile, suffix)
+    # Generate one ICM script per concurrent ICM process, each indexing its
+    # share of the libraries
+    nproc = min(nproc, len(pairs))
+    scriptPaths = [generateScript(icm, pairs[i::nproc]) for i in
+                   range(nproc)]
 
-    # Execute the script
-    executeScript(icm, scriptPath, sdfFile, suffix)
+    # Execute the scripts
+    executeScripts(icm, scriptPaths, pairs)
 
 
 def getPath():
@@ -60,13 +131,36 @@ def parseArgs():
     """
 
     descr = "Create a .inx file of a .sdf file for VS"
-    descr_sdf = "Provide a .sdf library to create a .inx file for"
+    descr_sdf = "Provide the .sdf libraries to create a .inx file for, " \
+                "each a file or a quoted glob pattern"
     descr_suffix = "Provide a suffix that will identify the cluster for " \
-                   "this index is designed"
+                   "this index is designed. Several suffixes can be " \
+                   "separated by commas"
+    descr_native = "Index the .sdf without ICM, writing a record-offset " \
+                   "index (.idx) instead of the ICM .inx"
+    descr_nproc = "Number of processes scanning byte ranges of the .sdf in " \
+                  "parallel (with -native), or of concurrent ICM processes " \
+                  "sharing the libraries to index. Default is 1"
+    descr_extract = "Write the ligands of an ID range (format: 1-1000) " \
+                    "to their own .sdf, using the .idx index of this " \
+                    "library and suffix"
+    descr_rebuild = "Re-index the whole library with -native, even if it " \
+                    "was only appended to since the last index"
+    descr_props = "With -native, also compute heavy atom, rotatable bond, " \
+                  "H-bond donor and N+O counts of each ligand into a " \
+                  "sidecar directory (_props) next to the .idx"
+    descr_dedup = "With -native, also hash the connection table of each " \
+                  "ligand (.hash) and report duplicate structures (.dup)"
 
     parser = argparse.ArgumentParser(description=descr)
-    parser.add_argument("sdf", help=descr_sdf)
+    parser.add_argument("sdf", nargs="+", help=descr_sdf)
     parser.add_argument("suffix", help=descr_suffix)
+    parser.add_argument("-native", action="store_true", help=descr_native)
+    parser.add_argument("--nproc", help=descr_nproc)
+    parser.add_argument("--extract", help=descr_extract)
+    parser.add_argument("-rebuild", action="store_true", help=descr_rebuild)
+    parser.add_argument("-props", action="store_true", help=descr_props)
+    parser.add_argument("-dedup", action="store_true", help=descr_dedup)
 
     try:
         args = parser.parse_args()
@@ -76,63 +170,929 @@ def parseArgs():
         print("***************************************\n")
         sys.exit()
 
-    sdfFile = args.sdf
-    suffix = args.suffix
+    # Each library given, or those its glob pattern matches
+    sdfFiles = []
+    for sdfPattern in args.sdf:
+        matches = sorted(glob.glob(sdfPattern))
+        if not matches:
+            print("No library found matching: " + sdfPattern)
+            sys.exit()
+        sdfFiles += [sdfFile for sdfFile in matches
+                     if sdfFile not in sdfFiles]
+    suffixes = args.suffix.split(",")
+    native = args.native
+    nproc = args.nproc
+    extract = args.extract
+    rebuild = args.rebuild
+    props = args.props
+    dedup = args.dedup
+
+    # Default to a serial scan
+    if nproc:
+        nproc = int(nproc)
+    else:
+        nproc = 1
+
+    # Make the extracted range a pair of ints
+    if extract:
+        extract = [int(ligID) for ligID in extract.split("-")]
 
-    return sdfFile, suffix
+    return sdfFiles, suffixes, native, nproc, extract, rebuild, props, dedup
 
 
-def generateScript(icm, sdfFile, suffix):
+def generateScript(icm, pairs):
     """
-    Generate the ICM script in the current working directory
-    Modify its content to apply to the .sdf and .inx files
+    Generate an ICM script in the current working directory, indexing each
+    of the (.sdf, suffix) pairs given. Each script gets a unique name so that
+    several can run side by side
     """
 
     # Script base
     scr_string = """#!ICM_EXEC
 call "_startup"
 
-# Create the .inx file, that indexes this database
-makeIndexChemDb "SDF_LIB" "INX_FILE" "mol" { "ICMID" }
-
+# Create the .inx files, that index these databases
+MAKE_INDEX
 quit
 """
 
-    # Modify the script
+    # One makeIndexChemDb call per library and suffix
     workDir = os.getcwd()
-    sdfPath = workDir + "/" + sdfFile
-    inxPath = sdfPath.replace(".sdf", "_" + suffix + ".inx")
-    scr_string = scr_string.replace("SDF_LIB", sdfPath)
-    scr_string = scr_string.replace("INX_FILE", inxPath)
-    scr_string = scr_string.replace("ICM_EXEC", icm)
+    makeIndex = ""
+    for sdfFile, suffix in pairs:
+        sdfPath = os.path.join(workDir, sdfFile)
+        inxPath = indexPath(sdfPath, suffix, ".inx")
+        makeIndex += 'makeIndexChemDb "' + sdfPath + '" "' + inxPath + \
+            '" "mol" { "ICMID" }\n'
 
-    # print scr_string
+    # Modify the script
+    scr_string = scr_string.replace("MAKE_INDEX", makeIndex)
+    scr_string = scr_string.replace("ICM_EXEC", icm)
 
     # Write it to file
-    scr_path = workDir + "/temp.icm"
-    with open(scr_path, "w") as scr_file:
+    scr_fd, scr_path = tempfile.mkstemp(prefix="temp_", suffix=".icm",
+                                        dir=workDir)
+    with os.fdopen(scr_fd, "w") as scr_file:
         scr_file.write(scr_string)
 
     return scr_path
 
 
-def executeScript(icm, scriptPath, sdfFile, suffix):
+def executeScripts(icm, scriptPaths, pairs):
     """
-    Execute the index.icm script
+    Execute the index scripts as concurrent ICM processes
     """
 
-    print("\nCreating .inx for: \t" + sdfFile)
-    print("Will work on: \t" + suffix + "\n")
+    for sdfFile, suffix in pairs:
+        print("\nCreating .inx for: \t" + sdfFile)
+        print("Will work on: \t" + suffix)
+    print("\nICM processes: \t" + str(len(scriptPaths)) + "\n")
 
-    # Execute
-    try:
-        check_output(icm + " -s " + scriptPath, stderr=STDOUT, shell=True)
-    except CalledProcessError as e:
-        print("\n Error executing the ICM script")
-        print(e.output)
+    # Start all, then wait for each of them
+    procs = [Popen(icm + " -s " + scriptPath, stdout=PIPE, stderr=STDOUT,
+                   shell=True) for scriptPath in scriptPaths]
+    failed = False
+    for proc, scriptPath in zip(procs, scriptPaths):
+        output = proc.communicate()[0]
+        if proc.returncode != 0:
+            print("\n Error executing the ICM script " + scriptPath)
+            print(output)
+            failed = True
+        # Delete
+        os.remove(scriptPath)
+
+    if failed:
+        sys.exit()
+
+
+def indexPath(sdfFile, suffix, ext):
+    """
+    Path of an index file for this .sdf (or .sdf.gz) and suffix, written next
+    to the library
+    """
+
+    base = sdfFile[:sdfFile.rfind(".sdf")] if ".sdf" in sdfFile else sdfFile
+
+    return base + "_" + suffix + ext
+
+
+def nativeIndex(sdfFile, suffix, nproc, rebuild, props, dedup):
+    """
+    Stream the .sdf once through a memory map and write a record-offset index
+    with one line per ligand: ligand ID, byte offset, length and ICMID.
+    With nproc > 1 the file is split into byte ranges scanned by a pool of
+    processes, and their partial indexes are merged in offset order.
+    A BGZF library is streamed block by block instead, and each ligand is
+    located by its compressed block offset and its offset within the block.
+    The index ends with a footer recording the library size and a hash of the
+    last record: if the library was only appended to since, only the new
+    records are scanned and added to the existing index.
+    With props, the ligand properties are written to the _props sidecar.
+    With dedup, the connection table hashes are written to the .hash index
+    and the duplicates they reveal to the .dup report
+    """
+
+    idxPath = indexPath(sdfFile, suffix, ".idx")
+    propsDir = indexPath(sdfFile, suffix, "_props")
+    hashPath = indexPath(sdfFile, suffix, ".hash")
+    dupPath = indexPath(sdfFile, suffix, ".dup")
+    bgzf = isBgzf(sdfFile)
+
+    print("\nIndexing: \t" + sdfFile)
+    print("Writing: \t" + idxPath + "\n")
+
+    # Check whether the existing index still matches the start of the library
+    resume = None
+    if not rebuild and os.path.exists(idxPath):
+        resume = checkIndex(sdfFile, idxPath, bgzf)
+        # The sidecar must cover the same ligands to be appended to
+        if resume and props and propsCount(propsDir) != resume[0]:
+            resume = None
+        if resume and dedup and (not os.path.exists(hashPath) or
+                                 os.path.getsize(hashPath) // 8 != resume[0]):
+            resume = None
+        if resume:
+            print("Index matches the library up to ligand " +
+                  str(resume[0]) + ", indexing the records after it only\n")
+        else:
+            print("Library changed since it was indexed, rebuilding\n")
+
+    # A property sidecar, hash index or duplicate report not written along
+    # with the index would no longer match its ligand IDs
+    if not props and os.path.exists(propsDir):
+        print("Removing the property sidecar of the previous index: " +
+              propsDir + "\n")
+        shutil.rmtree(propsDir)
+    if not dedup:
+        for sidecarPath in (hashPath, dupPath):
+            if os.path.exists(sidecarPath):
+                print("Removing the duplicate detection files of the " +
+                      "previous index: " + sidecarPath + "\n")
+                os.remove(sidecarPath)
+
+    with open(sdfFile, "rb") as sdf:
+        size = os.fstat(sdf.fileno()).st_size
+
+        # Drop the footer of the existing index and append after it, or
+        # start a new index
+        if resume:
+            ligCount, last, start, footerPos = resume
+            with open(idxPath, "rb+") as idx:
+                idx.truncate(footerPos)
+            idx = open(idxPath, "a")
+        else:
+            ligCount, last, start = 0, None, 0
+            idx = open(idxPath, "w")
+            idx.write("#source\t" + os.path.basename(sdfFile) + "\n")
+            if bgzf:
+                idx.write("#ligID\tblockOffset\tinBlockOffset\tlength\t" +
+                          "ICMID\n")
+            else:
+                idx.write("#ligID\toffset\tlength\tICMID\n")
+
+        # Property columns, buffered and appended to their files
+        if props:
+            if not os.path.exists(propsDir):
+                os.makedirs(propsDir)
+            if not resume:
+                for column in PROP_COLUMNS:
+                    open(os.path.join(propsDir, column + ".u16"), "wb").close()
+            propCols = [array.array("H") for column in PROP_COLUMNS]
+
+        # Connection table hashes, buffered and appended to the .hash index
+        if dedup:
+            if not resume:
+                open(hashPath, "wb").close()
+            hashCol = array.array("Q")
+
+        mm = None
+        pool = None
+        if bgzf:
+            if nproc > 1:
+                print("BGZF libraries are indexed by a single process\n")
+            sdf.seek(start)
+            records = scanBgzf(sdf, props, dedup)
+        # An empty file cannot be memory mapped, and has nothing to index
+        elif start < size:
+            mm = mmap.mmap(sdf.fileno(), 0, access=mmap.ACCESS_READ)
+
+            # Partial indexes come back in the order of their byte ranges,
+            # which is offset order: the ligand IDs can be numbered as they
+            # are written
+            if nproc > 1:
+                pool = multiprocessing.Pool(nproc)
+                chunks = [(sdfFile, chunkStart, chunkStop, props, dedup) for
+                          chunkStart, chunkStop in
+                          chunkRanges(start, size, nproc)]
+                records = itertools.chain.from_iterable(
+                    pool.imap(indexChunk, chunks))
+            else:
+                records = scanRecords(mm, start, size, props, dedup)
+        else:
+            records = []
+
+        for record in records:
+            ligCount += 1
+            # The hash and properties come last, after the index fields
+            if dedup:
+                record, connHash = record[:-1], record[-1]
+                hashCol.append(connHash)
+                if len(hashCol) >= 1000000:
+                    writeHashes(hashPath, hashCol)
+            if props:
+                record, ligProps = record[:-1], record[-1]
+                for propCol, val in zip(propCols, ligProps):
+                    propCol.append(min(val, 65535))
+                if len(propCols[0]) >= 1000000:
+                    writeProps(propsDir, propCols)
+            idx.write(str(ligCount) + "\t" +
+                      "\t".join([str(val) for val in record]) + "\n")
+            last = record
+
+        if pool:
+            pool.close()
+            pool.join()
+        if mm:
+            mm.close()
+        if props:
+            writeProps(propsDir, propCols)
+        if dedup:
+            writeHashes(hashPath, hashCol)
+
+        # Fingerprint of the library as indexed, the (offset, length) of the
+        # last record is read back from it
+        if last is None:
+            lastHash = "none"
+        elif bgzf:
+            lastHash = hashRecord(sdf, (last[0], last[1]), last[2])
+        else:
+            lastHash = hashRecord(sdf, last[0], last[1])
+        idx.write("#footer\tsize=" + str(size) + "\tlastHash=" + lastHash +
+                  "\n")
+        idx.close()
+
+    print("Indexed " + str(ligCount) + " ligands\n")
+
+    # The report covers the whole library, appended records included
+    if dedup:
+        dupCount = writeDupes(hashPath, dupPath)
+        print("Found " + str(dupCount) + " duplicates, listed in: \t" +
+              dupPath + "\n")
+
+
+def checkIndex(sdfFile, idxPath, bgzf):
+    """
+    Compare an existing index to the library through its footer. If the
+    library only grew and still holds the last indexed record unchanged,
+    return (ligCount, lastRecord, resumeOffset, footerPos), None otherwise
+    """
+
+    # The footer and last entry are at the end of the index
+    with open(idxPath, "rb") as idx:
+        idx.seek(0, os.SEEK_END)
+        idxSize = idx.tell()
+        idx.seek(max(0, idxSize - 4096))
+        tail = idx.read()
+
+    lines = tail.split(b"\n")
+    if len(lines) < 3 or not lines[-2].startswith(b"#footer"):
+        return None
+    footerPos = idxSize - len(lines[-2]) - 1
+
+    footer = dict([field.split("=") for field in
+                   lines[-2].decode().split("\t")[1:]])
+    entry = lines[-3].decode().split("\t")
+    size = os.path.getsize(sdfFile)
+    if footer["lastHash"] == "none" or size < int(footer["size"]):
+        return None
+
+    # The columns tell whether the index was of a BGZF or a plain library
+    if bgzf and len(entry) == 5:
+        offset = (int(entry[1]), int(entry[2]))
+        record = offset + (int(entry[3]), entry[4])
+        start = int(footer["size"])
+    elif not bgzf and len(entry) == 4:
+        offset = int(entry[1])
+        record = (offset, int(entry[2]), entry[3])
+        start = offset + int(entry[2])
+    else:
+        return None
+
+    with open(sdfFile, "rb") as sdf:
+        lastHash = hashRecord(sdf, offset, record[-2])
+        data = b"".join(readSpan(sdf, offset, record[-2]))
+
+    # An unterminated last record would run on into the appended data
+    if lastHash != footer["lastHash"] or findRecordEnd(data, 0) != len(data):
+        return None
+
+    return int(entry[0]), record, start, footerPos
+
+
+def hashRecord(sdf, offset, length):
+    """
+    Hash the record found at an index offset of the library
+    """
+
+    sha = hashlib.sha1()
+    for data in readSpan(sdf, offset, length):
+        sha.update(data)
+
+    return sha.hexdigest()
+
+
+def chunkRanges(start, size, nproc):
+    """
+    Split the bytes from start to size into ranges, at least a few per
+    process so that uneven ranges still balance across the pool
+    """
+
+    chunkNum = max(nproc * 4, (size - start) // CHUNK_BYTES + 1)
+    step = (size - start) // chunkNum + 1
+
+    return [(chunkStart, min(chunkStart + step, size)) for chunkStart in
+            range(start, size, step)]
+
+
+def indexChunk(chunk):
+    """
+    Pool worker: index the records starting within one byte range of the .sdf
+    """
+
+    sdfFile, start, stop, props, dedup = chunk
+
+    with open(sdfFile, "rb") as sdf:
+        mm = mmap.mmap(sdf.fileno(), 0, access=mmap.ACCESS_READ)
+        # Snap to the first record boundary of this range, the record
+        # straddling it belongs to the previous range
+        records = list(scanRecords(mm, snapRecord(mm, start), stop, props,
+                                   dedup))
+        mm.close()
+
+    return records
+
+
+def snapRecord(mm, pos):
+    """
+    Return the offset of the first record starting at or after pos
+    """
+
+    if pos == 0:
+        return 0
+
+    # Look for the first $$$$ line ending at or after pos, starting from the
+    # line that contains the byte just before pos
+    lineStart = mm.rfind(b"\n", 0, pos - 1) + 1
+
+    return recordEnd(mm, lineStart, len(mm))
+
+
+def scanRecords(mm, start, stop, props, dedup):
+    """
+    Yield (offset, length, ICMID) for every record of the memory mapped .sdf
+    that starts in [start, stop), followed by the ligand properties if props
+    and the connection table hash if dedup. start must be the start of a
+    record
+    """
+
+    size = len(mm)
+    pos = start
+
+    while pos < stop:
+        end = recordEnd(mm, pos, size)
+        # Skip trailing blank lines after the last $$$$
+        if end < size or mm[pos:end].strip():
+            record = (pos, end - pos, readField(mm, pos, end, b"<ICMID>"))
+            if props or dedup:
+                record += recordExtras(mm[pos:end], props, dedup)
+            yield record
+        pos = end
+
+
+def recordEnd(mm, pos, size):
+    """
+    Return the offset just after the $$$$ line that closes the record
+    starting at pos (or the end of the file for an unterminated record)
+    """
+
+    end = findRecordEnd(mm, pos)
+
+    return size if end == -1 else end
+
+
+def findRecordEnd(buf, pos):
+    """
+    Return the offset just after the first complete $$$$ line at or after
+    pos, -1 if buf does not contain one yet
+    """
+
+    i = buf.find(b"$$$$", pos)
+    # The delimiter only counts at the start of a line
+    while i > pos and buf[i - 1] != 10:
+        i = buf.find(b"$$$$", i + 1)
+    if i == -1:
+        return -1
+
+    j = buf.find(b"\n", i)
+    if j == -1:
+        return -1
+
+    return j + 1
+
+
+def readField(mm, start, end, tag):
+    """
+    Return the value of the SDF data field tag within [start, end), 'none' if
+    the record does not have it
+    """
+
+    i = mm.find(tag, start, end)
+    if i == -1:
+        return "none"
+
+    # The value is on the line following the data header
+    i = mm.find(b"\n", i, end) + 1
+    j = mm.find(b"\n", i, end)
+    if i == 0 or j == -1:
+        return "none"
+
+    value = mm[i:j].strip().decode("ascii", "replace")
+
+    return value if value else "none"
+
+
+def isBgzf(sdfFile):
+    """
+    Check whether the library is block-gzip compressed (BGZF). Exits on a
+    plain gzip file, which cannot be accessed at random
+    """
+
+    with open(sdfFile, "rb") as f:
+        header = f.read(18)
+
+    if not header.startswith(b"\x1f\x8b"):
+        return False
+
+    if not header.startswith(BGZF_MAGIC) or header[12:14] != b"BC":
+        print(sdfFile + " is gzip but not BGZF compressed, recompress it " +
+              "with 'bgzip' to index it. Exiting.")
         sys.exit()
-    # Delete
-    os.remove("./temp.icm")
+
+    return True
+
+
+def readBgzfBlock(f):
+    """
+    Read the BGZF block at the current position of f, return its compressed
+    size and inflated data (None at the end of the file)
+    """
+
+    header = f.read(12)
+    if len(header) < 12:
+        return None
+
+    # The extra field holds the BC subfield, giving the total block size
+    xlen = struct.unpack("<H", header[10:12])[0]
+    extra = f.read(xlen)
+    bsize = None
+    i = 0
+    while i < xlen:
+        slen = struct.unpack("<H", extra[i + 2:i + 4])[0]
+        if extra[i:i + 2] == b"BC":
+            bsize = struct.unpack("<H", extra[i + 4:i + 6])[0] + 1
+        i += 4 + slen
+    if not header.startswith(BGZF_MAGIC) or bsize is None:
+        print("Corrupted BGZF block at offset " +
+              str(f.tell() - 12 - xlen) + ". Exiting.")
+        sys.exit()
+
+    # Compressed data, followed by the CRC32 and inflated size
+    cdata = f.read(bsize - 12 - xlen - 8)
+    f.read(8)
+
+    return bsize, zlib.decompress(cdata, -15)
+
+
+def scanBgzf(f, props, dedup):
+    """
+    Stream a BGZF library from the current position of f and yield
+    (blockOffset, inBlockOffset, length, ICMID) for every record, followed by
+    the ligand properties if props and the connection table hash if dedup
+    """
+
+    # Inflated data from the start of the current record on, with the
+    # (buffer offset, compressed offset) of each block it was read from
+    buf = b""
+    blocks = []
+    pos = 0
+    coffset = f.tell()
+
+    while True:
+        block = readBgzfBlock(f)
+        if block is None:
+            break
+        bsize, data = block
+        if data:
+            blocks.append((len(buf), coffset))
+            buf += data
+        coffset += bsize
+
+        end = findRecordEnd(buf, pos)
+        while end != -1:
+            record = locateBgzf(blocks, pos) + \
+                (end - pos, readField(buf, pos, end, b"<ICMID>"))
+            if props or dedup:
+                record += recordExtras(buf[pos:end], props, dedup)
+            yield record
+            pos = end
+            end = findRecordEnd(buf, pos)
+
+        # Drop the blocks the current record does not reach back into
+        while len(blocks) > 1 and blocks[1][0] <= pos:
+            blocks.pop(0)
+        if blocks and blocks[0][0] > 0:
+            shift = blocks[0][0]
+            buf = buf[shift:]
+            pos -= shift
+            blocks = [(bufOffset - shift, blockOffset) for
+                      bufOffset, blockOffset in blocks]
+
+    # Last record, not terminated by $$$$
+    if buf[pos:].strip():
+        record = locateBgzf(blocks, pos) + \
+            (len(buf) - pos, readField(buf, pos, len(buf), b"<ICMID>"))
+        if props or dedup:
+            record += recordExtras(buf[pos:], props, dedup)
+        yield record
+
+
+def locateBgzf(blocks, pos):
+    """
+    Return the (blockOffset, inBlockOffset) of a position of the inflated
+    buffer
+    """
+
+    for bufOffset, blockOffset in reversed(blocks):
+        if bufOffset <= pos:
+            return blockOffset, pos - bufOffset
+
+
+def recordExtras(data, props, dedup):
+    """
+    Values computed from a record in addition to its index fields: its
+    properties if props, then its connection table hash if dedup
+    """
+
+    extras = ()
+    if props:
+        extras += (recordProps(data),)
+    if dedup:
+        extras += (recordHash(data),)
+
+    return extras
+
+
+def recordHash(data):
+    """
+    64-bit hash of the normalised connection table of a record: the atom
+    block without coordinates, the bond block and the property lines. The
+    name, comment and data fields are left out
+    """
+
+    lines = data.split(b"\n")
+    sha = hashlib.sha1()
+    try:
+        atomNum = int(lines[3][0:3])
+    except (IndexError, ValueError):
+        atomNum = 0
+
+    # Only hash the connection table, up to M  END
+    for i, line in enumerate(lines[3:]):
+        line = line.rstrip()
+        if line.startswith(b"M  END"):
+            break
+        # Atom lines: drop the x, y, z columns
+        if 1 <= i <= atomNum:
+            line = line[30:]
+        sha.update(line + b"\n")
+
+    return struct.unpack("<Q", sha.digest()[:8])[0]
+
+
+def recordProps(data):
+    """
+    Compute (heavyAtoms, rotBonds, hDonors, nNO) from the connection table of
+    a V2000 record. Records that cannot be read get zeros, which no docking
+    limit rejects
+    """
+
+    lines = data.split(b"\n")
+    try:
+        atomNum = int(lines[3][0:3])
+        bondNum = int(lines[3][3:6])
+        atomLines = lines[4:4 + atomNum]
+        bondLines = lines[4 + atomNum:4 + atomNum + bondNum]
+        elements = [line[31:34].strip().decode() for line in atomLines]
+        charges = [CHARGE_CODES.get(int(line[36:39] or 0), 0) for line in
+                   atomLines]
+        bonds = [(int(line[0:3]) - 1, int(line[3:6]) - 1, int(line[6:9]))
+                 for line in bondLines]
+    except (IndexError, ValueError):
+        return 0, 0, 0, 0
+
+    if len(elements) < atomNum or len(bonds) < bondNum:
+        return 0, 0, 0, 0
+    for a, b, order in bonds:
+        if not (0 <= a < atomNum and 0 <= b < atomNum):
+            return 0, 0, 0, 0
+
+    # Charges given in the property block replace those of the atom block
+    for line in lines[4 + atomNum + bondNum:]:
+        if line.startswith(b"M  END"):
+            break
+        if line.startswith(b"M  CHG"):
+            ll = line.split()
+            for i in range(3, len(ll) - 1, 2):
+                try:
+                    atom = int(ll[i]) - 1
+                    charge = int(ll[i + 1])
+                except ValueError:
+                    return 0, 0, 0, 0
+                if not 0 <= atom < atomNum:
+                    return 0, 0, 0, 0
+                charges[atom] = charge
+
+    heavy = [el not in ("H", "D") for el in elements]
+    neighbours = [[] for el in elements]
+    valences = [0.] * atomNum
+    for a, b, order in bonds:
+        neighbours[a].append(b)
+        neighbours[b].append(a)
+        # Aromatic bonds (4) count as one and a half
+        valences[a] += 1.5 if order == 4 else order
+        valences[b] += 1.5 if order == 4 else order
+
+    # Donors: N and O holding an explicit or implicit hydrogen
+    hDonors = 0
+    for i, el in enumerate(elements):
+        if el in DONOR_VALENCE:
+            explicitH = any(not heavy[j] for j in neighbours[i])
+            implicitH = DONOR_VALENCE[el] + charges[i] - int(valences[i])
+            if explicitH or implicitH > 0:
+                hDonors += 1
+
+    # Rotatable: single, acyclic bonds between two non-terminal heavy atoms
+    ringBonds = findRingBonds(neighbours)
+    rotBonds = 0
+    for a, b, order in bonds:
+        if order != 1 or not heavy[a] or not heavy[b] or \
+                (min(a, b), max(a, b)) in ringBonds:
+            continue
+        if sum(heavy[j] for j in neighbours[a]) > 1 and \
+                sum(heavy[j] for j in neighbours[b]) > 1:
+            rotBonds += 1
+
+    return (sum(heavy), rotBonds, hDonors,
+            sum(el in ("N", "O") for el in elements))
+
+
+def findRingBonds(neighbours):
+    """
+    Return the set of bonds (as sorted atom pairs) that belong to a ring, i.e.
+    that are not bridges of the molecular graph (iterative Tarjan search)
+    """
+
+    atomNum = len(neighbours)
+    order = [-1] * atomNum
+    low = [0] * atomNum
+    bridges = set()
+    counter = 0
+
+    for root in range(atomNum):
+        if order[root] != -1:
+            continue
+        order[root] = low[root] = counter
+        counter += 1
+        # Stack of (atom, parent, iterator over its neighbours)
+        stack = [(root, -1, iter(neighbours[root]))]
+        while stack:
+            atom, parent, children = stack[-1]
+            child = next(children, None)
+            if child is None:
+                stack.pop()
+                if parent != -1:
+                    low[parent] = min(low[parent], low[atom])
+                    if low[atom] > order[parent]:
+                        bridges.add((min(atom, parent), max(atom, parent)))
+            elif child == parent:
+                continue
+            elif order[child] == -1:
+                order[child] = low[child] = counter
+                counter += 1
+                stack.append((child, atom, iter(neighbours[child])))
+            else:
+                low[atom] = min(low[atom], order[child])
+
+    ringBonds = set()
+    for a in range(atomNum):
+        for b in neighbours[a]:
+            if a < b and (a, b) not in bridges:
+                ringBonds.add((a, b))
+
+    return ringBonds
+
+
+def writeProps(propsDir, propCols):
+    """
+    Append the buffered property columns to their little-endian uint16
+    files, and empty the buffers
+    """
+
+    for column, propCol in zip(PROP_COLUMNS, propCols):
+        if sys.byteorder == "big":
+            propCol.byteswap()
+        with open(os.path.join(propsDir, column + ".u16"), "ab") as f:
+            propCol.tofile(f)
+        del propCol[:]
+
+
+def writeHashes(hashPath, hashCol):
+    """
+    Append the buffered connection table hashes to the little-endian uint64
+    .hash index, and empty the buffer
+    """
+
+    if sys.byteorder == "big":
+        hashCol.byteswap()
+    with open(hashPath, "ab") as f:
+        hashCol.tofile(f)
+    del hashCol[:]
+
+
+def writeDupes(hashPath, dupPath):
+    """
+    Write the duplicate report of a .hash index: each ligand ID whose
+    structure was already seen, with the first (canonical) ID of that
+    structure. Return the number of duplicates
+    """
+
+    hashCol = array.array("Q")
+    with open(hashPath, "rb") as f:
+        hashCol.fromfile(f, os.path.getsize(hashPath) // 8)
+    if sys.byteorder == "big":
+        hashCol.byteswap()
+
+    canonical = {}
+    dupCount = 0
+    with open(dupPath, "w") as dup:
+        dup.write("#dupID\tcanonicalID\n")
+        for ligID, connHash in enumerate(hashCol, 1):
+            canonID = canonical.setdefault(connHash, ligID)
+            if canonID != ligID:
+                dup.write(str(ligID) + "\t" + str(canonID) + "\n")
+                dupCount += 1
+
+    return dupCount
+
+
+def readDupes(dupPath):
+    """
+    Read a .dup report into a dictionary of duplicate ID: canonical ID
+    """
+
+    dupes = {}
+    with open(dupPath) as dup:
+        for line in dup:
+            if line.startswith("#"):
+                continue
+            dupID, canonID = line.split()
+            dupes[int(dupID)] = int(canonID)
+
+    return dupes
+
+
+def propsCount(propsDir):
+    """
+    Number of ligands covered by a property sidecar, -1 if it is missing or
+    its columns disagree
+    """
+
+    counts = set()
+    for column in PROP_COLUMNS:
+        colPath = os.path.join(propsDir, column + ".u16")
+        if not os.path.exists(colPath):
+            return -1
+        counts.add(os.path.getsize(colPath) // 2)
+
+    return counts.pop() if len(counts) == 1 else -1
+
+
+def readProps(propsDir, columns=PROP_COLUMNS, ligFrom=1, ligTo=None):
+    """
+    Load property columns of a sidecar into a dictionary of uint16 arrays,
+    where item i holds the value of ligand ID ligFrom + i. Only the ligands
+    up to ligTo are read if given
+    """
+
+    props = {}
+    for column in columns:
+        colPath = os.path.join(propsDir, column + ".u16")
+        count = os.path.getsize(colPath) // 2 - (ligFrom - 1)
+        if ligTo is not None:
+            count = min(count, ligTo - ligFrom + 1)
+        propCol = array.array("H")
+        with open(colPath, "rb") as f:
+            f.seek((ligFrom - 1) * 2)
+            propCol.fromfile(f, max(0, count))
+        if sys.byteorder == "big":
+            propCol.byteswap()
+        props[column] = propCol
+
+    return props
+
+
+def readIndex(idxPath):
+    """
+    Yield [ligID, offset, length, ICMID] for every ligand of a .idx index.
+    For a BGZF library offset is the (blockOffset, inBlockOffset) pair
+    """
+
+    with open(idxPath) as idx:
+        for line in idx:
+            if line.startswith("#"):
+                continue
+            ll = line.rstrip("\n").split("\t")
+            if len(ll) == 5:
+                yield [int(ll[0]), (int(ll[1]), int(ll[2])), int(ll[3]), ll[4]]
+            else:
+                yield [int(ll[0]), int(ll[1]), int(ll[2]), ll[3]]
+
+
+def indexSource(idxPath):
+    """
+    Path of the library a .idx index was written for, from its #source line
+    """
+
+    with open(idxPath) as idx:
+        for line in idx:
+            if not line.startswith("#"):
+                break
+            if line.startswith("#source\t"):
+                return os.path.join(os.path.dirname(idxPath),
+                                    line.rstrip("\n").split("\t")[1])
+
+    return None
+
+
+def extractRange(sdfFile, idxPath, ligFrom, ligTo, outPath):
+    """
+    Write the records of ligands ligFrom to ligTo (included) to outPath,
+    seeking straight to the first of them through the index
+    """
+
+    # The records of an ID range are contiguous in the library
+    first = None
+    length = 0
+    for ligID, offset, ligLength, icmid in readIndex(idxPath):
+        if ligID > ligTo:
+            break
+        if ligID >= ligFrom:
+            if first is None:
+                first = offset
+            length += ligLength
+
+    with open(sdfFile, "rb") as sdf, open(outPath, "wb") as out:
+        if first is None:
+            return
+        for data in readSpan(sdf, first, length):
+            out.write(data)
+
+
+def readSpan(sdf, offset, length):
+    """
+    Yield the length bytes of library content found at an index offset, an
+    int for a plain .sdf or a (blockOffset, inBlockOffset) pair for BGZF
+    """
+
+    if isinstance(offset, tuple):
+        blockOffset, inBlockOffset = offset
+        sdf.seek(blockOffset)
+        while length > 0:
+            block = readBgzfBlock(sdf)
+            if block is None:
+                break
+            data = block[1][inBlockOffset:inBlockOffset + length]
+            inBlockOffset = 0
+            length -= len(data)
+            yield data
+    else:
+        sdf.seek(offset)
+        while length > 0:
+            data = sdf.read(min(length, CHUNK_BYTES))
+            if not data:
+                break
+            length -= len(data)
+            yield data
 
 
 if __name__ == "__main__":
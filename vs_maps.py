@@ -4,6 +4,22 @@
 # the target protein only. The .inx index file pointing
 # to the library to be used must also be provided.
 # It uses an .icm script to create the ICM docking maps.
+# Given several .ob files (a receptor ensemble), maps are built for each of
+# them by a pool of --nproc ICM processes, each in its own vs_setup_<name>
+# directory with its own script.
+# With --cache, the files ICM produces are kept in a shared cache directory,
+# keyed by a hash of the receptor file, map mode, pocket or residue list and
+# grid parameters. A setup rebuilt with the same inputs gets its maps back
+# from the cache instead of recomputing them. The least recently used entries
+# are evicted past --cacheSize GB.
+# With --topPockets N, icmPocketFinder runs once per receptor and the list of
+# all its pockets, ranked by volume, is written to <name>_pockets.csv. The
+# receptor and its pockets
+# are saved to <name>_pockets.icb, from which the maps of the N largest
+# pockets are built in parallel, each in its own vs_setup_<name>_pocket<i>
+# directory.
+# As these files and directories are named after the receptor file, receptors
+# with the same file name (e.g. a/rec.ob and b/rec.ob) are refused.
 #
 # https://github.com/thomas-coudrat/toolbx_vs
 # Thomas Coudrat <thomas.coudrat@gmail.com>
@@ -11,9 +27,19 @@
 import os
 import sys
 import argparse
+import csv
+import hashlib
 import socket
+import shutil
+import tempfile
+import time
+import multiprocessing
 from subprocess import check_output, STDOUT, CalledProcessError
 import json
+import dtb
+
+# Grid parameters given to dock5CalcMaps, part of the map cache key
+MAP_PARAMS = "0.5 4.0"
 
 def main():
     """
@@ -24,33 +50,351 @@ def main():
     icm = getPath()
 
     # Get the arguments
-    obPath, inxPath, dbType, mapMode, pocket, residues = parseArgs()
-
-    # Generate script (will return the script relevant to the mode chosen)
-    script = generateScript(mapMode, obPath, pocket, icm, residues)
-
-    # Run the .icm script
-    runScript(icm, script)
-
-    # Set of calls to modify the .dtb file
-    modifyDtb("i_maxHdonor", "  15", obPath)
-    modifyDtb("i_maxLigSize", "  1000", obPath)
-    modifyDtb("i_maxNO", "  20", obPath)
-    modifyDtb("i_maxTorsion", "  20", obPath)
-    modifyDtb("i_ringFlexLevel", "  1", obPath)
-    modifyDtb("r_ScoreThreshold", "  -20", obPath)
-    modifyDtb("r_maxPk", "  15", obPath)
-    modifyDtb("r_minPk", "  -10", obPath)
-    modifyDtb("s_chargeGroups", "  auto", obPath)
-    modifyDtb("s_dbIndex", inxPath, obPath)
+    obPaths, inxPath, dbType, mapMode, pocket, residues, nproc, \
+        cacheDir, cacheSize, topPockets = parseArgs()
+
+    jobs = []
+    if topPockets:
+        # Detect the pockets of each receptor once, then set up its top
+        # pockets each in its own directory
+        found = runJobs(findPockets, [(icm, obPath) for obPath in obPaths],
+                        nproc)
+        for obPath, icbPath, pockets, error in found:
+            if error is not None:
+                print("\n" + obPath + ": pocket detection FAILED")
+                print(error)
+                continue
+            baseName = os.path.basename(obPath).replace(".ob", "")
+            if len(pockets) < topPockets:
+                print("\n" + obPath + ": only " + str(len(pockets)) +
+                      " pockets found")
+            # All pockets are listed, maps are built for the largest ones
+            for rank, pocket in enumerate(pockets):
+                if rank >= topPockets:
+                    pocket.append("")
+                    continue
+                workDir = "vs_setup_" + baseName + "_pocket" + pocket[0]
+                pocket.append(workDir)
+                jobs.append((icm, obPath, inxPath, dbType, mapMode,
+                             pocket[0], residues, workDir, cacheDir,
+                             cacheSize, icbPath))
+            writePockets(baseName + "_pockets.csv", pockets)
+    else:
+        # A single receptor is set up in the current directory, each receptor
+        # of an ensemble in its own directory
+        for obPath in obPaths:
+            if len(obPaths) == 1:
+                workDir = None
+            else:
+                workDir = "vs_setup_" + \
+                    os.path.basename(obPath).replace(".ob", "")
+            jobs.append((icm, obPath, inxPath, dbType, mapMode, pocket,
+                         residues, workDir, cacheDir, cacheSize, None))
+
+    # Build the maps, in a bounded pool of ICM processes for an ensemble
+    timings = runJobs(buildMaps, jobs, nproc)
+
+    printTimings(timings)
+
+
+def runJobs(function, jobs, nproc):
+    """
+    Run the function on each job, in a pool of up to nproc processes when
+    there are several jobs
+    """
+
+    if len(jobs) == 1:
+        return [function(jobs[0])]
+
+    pool = multiprocessing.Pool(max(1, min(nproc, len(jobs))))
+    results = pool.map(function, jobs)
+    pool.close()
+    pool.join()
+
+    return results
+
+
+def findPockets(job):
+    """
+    Run icmPocketFinder once on a receptor, and save the receptor with its
+    pockets to <name>_pockets.icb for the map building. Returns the receptor,
+    the .icb path, the ranked list of [pocket number, volume, area] and ICM
+    error output (None on success)
+    """
+
+    icm, obPath = job
+    baseName = os.path.basename(obPath).replace(".ob", "")
+    icbPath = os.path.abspath(baseName + "_pockets.icb")
+
+    scr_string = """#!ICM_EXEC
+
+call "_startup"
+
+openFile "OB_PATH"
+
+# Get pockets
+icmPocketFinder Mol(a_*.//DD) & a_*.!H,W 4.6 no no
+
+# Ranked pocket list: pocket number, volume and area
+for i=1,Nof(ICMPOCKET)
+  print "POCKET" i ICMPOCKET.Volume[i] ICMPOCKET.Area[i]
+endfor
+
+# Keep the receptor and its pockets for the map building
+writeProject "ICB_PATH" no
+
+quit
+"""
+    scr_string = scr_string.replace("ICM_EXEC", icm)
+    scr_string = scr_string.replace("OB_PATH", os.path.abspath(obPath))
+    scr_string = scr_string.replace("ICB_PATH", icbPath)
+
+    scr_fd, scr_path = tempfile.mkstemp(prefix="temp_", suffix=".icm",
+                                        dir=os.getcwd())
+    with os.fdopen(scr_fd, "w") as scr_file:
+        scr_file.write(scr_string)
+
+    try:
+        output = check_output(icm + " -s " + scr_path, stderr=STDOUT,
+                              shell=True)
+    except CalledProcessError as e:
+        return obPath, icbPath, [], e.output
+    finally:
+        os.remove(scr_path)
+
+    pockets = []
+    for line in output.decode().splitlines():
+        fields = line.split()
+        if len(fields) == 4 and fields[0] == "POCKET":
+            pockets.append(fields[1:])
+
+    # Ranked by decreasing volume, whatever order ICM listed them in
+    pockets.sort(key=lambda pocket: float(pocket[1]), reverse=True)
+
+    return obPath, icbPath, pockets, None
+
+
+def writePockets(pocketsPath, pockets):
+    """
+    Write the ranked pocket list of a receptor, with the setup directory of
+    each pocket (empty for those without maps), and print it
+    """
+
+    with open(pocketsPath, "w") as pocketsFile:
+        pocketsWriter = csv.writer(pocketsFile)
+        pocketsWriter.writerow(["pocket", "volume", "area", "setupDir"])
+        for pocket in pockets:
+            pocketsWriter.writerow(pocket)
+
+    print("\nPOCKETS: " + pocketsPath + "\n")
+    for number, volume, area, workDir in pockets:
+        print("\t#{:<4} volume {:>10} \tarea {:>10}\t{}".format(number, volume,
+                                                               area, workDir))
+
+
+def buildMaps(job):
+    """
+    Build the maps of one receptor and tune its .dtb. With a work directory
+    the .ob is copied there first and ICM runs in it. With a cache directory
+    the maps are restored from the cache when available, and stored into it
+    otherwise. With an .icb from findPockets, the maps are built around its
+    pocket without running the pocket detection again. Returns the receptor,
+    work directory, time taken, status (built, cached or FAILED) and ICM
+    error output (None on success)
+    """
+
+    icm, obPath, inxPath, dbType, mapMode, pocket, residues, workDir, \
+        cacheDir, cacheSize, icbPath = job
+    start = time.time()
+
+    if workDir:
+        if not os.path.exists(workDir):
+            os.makedirs(workDir)
+        shutil.copy(obPath, workDir)
+        obName = os.path.basename(obPath)
+    else:
+        obName = obPath
+
+    status = "built"
+    if cacheDir:
+        key = mapsKey(obPath, mapMode, pocket, residues)
+        if restoreMaps(cacheDir, key, workDir):
+            status = "cached"
+        else:
+            projName = os.path.basename(obPath).replace(".ob", "")
+            before = listFiles(workDir, projName)
+
+    if status == "built":
+        # Generate script (will return the script relevant to the mode chosen)
+        script = generateScript(mapMode, obName, pocket, icm, residues,
+                                workDir, icbPath)
+
+        # Run the .icm script
+        error = runScript(icm, script, workDir)
+        if error is not None:
+            return obPath, workDir, time.time() - start, "FAILED", error
+
+        # Keep the files written by ICM, before the .dtb is tuned
+        if cacheDir:
+            after = listFiles(workDir, projName)
+            newFiles = [fileName for fileName in after if
+                        after[fileName] != before.get(fileName)]
+            storeMaps(cacheDir, key, workDir, newFiles, cacheSize)
+
+    # Set of modifications to the .dtb file
+    if workDir:
+        obName = os.path.join(workDir, obName)
+    edits = {"i_maxHdonor": "  15",
+             "i_maxLigSize": "  1000",
+             "i_maxNO": "  20",
+             "i_maxTorsion": "  20",
+             "i_ringFlexLevel": "  1",
+             "r_ScoreThreshold": "  -20",
+             "r_maxPk": "  15",
+             "r_minPk": "  -10",
+             "s_chargeGroups": "  auto",
+             "s_dbIndex": inxPath}
     if dbType == "3D":
-        modifyDtb("s_dbType", "mol 3D", obPath)
-        modifyDtb("l_sampleRacemic", "  no", obPath)
-        modifyDtb("r_thTautomer", " -1.", obPath)
+        edits["s_dbType"] = "mol 3D"
+        edits["l_sampleRacemic"] = "  no"
+        edits["r_thTautomer"] = " -1."
     elif dbType == "2Drac":
-        modifyDtb("s_dbType", "mol 2D", obPath)
-        modifyDtb("l_sampleRacemic", "  yes", obPath)
-	modifyDtb("r_thTautomer", " 1.", obPath)
+        edits["s_dbType"] = "mol 2D"
+        edits["l_sampleRacemic"] = "  yes"
+        edits["r_thTautomer"] = " 1."
+
+    # Applied in a single write
+    dtbParams = dtb.dtb(obName.replace(".ob", ".dtb"))
+    dtbParams.set(edits)
+    dtbParams.write()
+
+    return obPath, workDir, time.time() - start, status, None
+
+
+def printTimings(timings):
+    """
+    Print the time taken to build the maps of each receptor, and the ICM
+    output of those that failed
+    """
+
+    print("\nRECEPTOR MAPS:\n")
+    for obPath, workDir, seconds, status, error in timings:
+        print("\t{:<40} {:>10.1f} s \t{}\t{}".format(obPath, seconds, status,
+                                                      workDir or "."))
+    for obPath, workDir, seconds, status, error in timings:
+        if error is not None:
+            print("\n" + obPath + ":")
+            print(error)
+    print("")
+
+
+def mapsKey(obPath, mapMode, pocket, residues):
+    """
+    Cache key of the maps of a receptor: hash of the receptor file content
+    and name, map mode, pocket number or residue list, and grid parameters
+    """
+
+    sha = hashlib.sha1()
+    with open(obPath, "rb") as obFile:
+        for data in iter(lambda: obFile.read(1024 * 1024), b""):
+            sha.update(data)
+
+    # Only the selection used by the map mode is part of the key
+    if mapMode == "pocket":
+        selection = pocket
+    elif mapMode == "residues":
+        selection = residues
+    else:
+        selection = ""
+    # The files ICM writes are named after the receptor
+    sha.update("\n".join([os.path.basename(obPath), mapMode, selection,
+                          MAP_PARAMS]).encode())
+
+    return sha.hexdigest()
+
+
+def listFiles(workDir, projName):
+    """
+    Map each file of the work directory named after the receptor projName (the
+    files ICM writes for it) to its (size, modification time). Files of other
+    receptors, set up concurrently in the same directory, are left out
+    """
+
+    workDir = workDir or os.getcwd()
+    files = {}
+    for fileName in os.listdir(workDir):
+        filePath = os.path.join(workDir, fileName)
+        if (fileName.startswith(projName + ".") or
+                fileName.startswith(projName + "_")) and \
+                os.path.isfile(filePath):
+            stat = os.stat(filePath)
+            files[fileName] = (stat.st_size, stat.st_mtime)
+
+    return files
+
+
+def restoreMaps(cacheDir, key, workDir):
+    """
+    Copy the cached files of this key into the work directory, and mark the
+    entry as recently used. Returns False on a cache miss
+    """
+
+    entryDir = os.path.join(cacheDir, key)
+    if not os.path.isdir(entryDir):
+        return False
+
+    for fileName in os.listdir(entryDir):
+        shutil.copy(os.path.join(entryDir, fileName), workDir or os.getcwd())
+    os.utime(entryDir, None)
+
+    return True
+
+
+def storeMaps(cacheDir, key, workDir, fileNames, cacheSize):
+    """
+    Store the given files of the work directory in the cache under this key,
+    then evict the least recently used entries past cacheSize bytes
+    """
+
+    if not os.path.exists(cacheDir):
+        os.makedirs(cacheDir)
+
+    # Fill a temporary entry and rename it, so that concurrent builds never
+    # see a partial entry
+    tempDir = tempfile.mkdtemp(prefix="tmp_", dir=cacheDir)
+    for fileName in fileNames:
+        shutil.copy(os.path.join(workDir or os.getcwd(), fileName), tempDir)
+    try:
+        os.rename(tempDir, os.path.join(cacheDir, key))
+    except OSError:
+        # Stored meanwhile by an other build
+        shutil.rmtree(tempDir)
+
+    evictMaps(cacheDir, cacheSize)
+
+
+def evictMaps(cacheDir, cacheSize):
+    """
+    Remove the least recently used cache entries until the cache holds no
+    more than cacheSize bytes
+    """
+
+    entries = []
+    totalSize = 0
+    for key in os.listdir(cacheDir):
+        entryDir = os.path.join(cacheDir, key)
+        if key.startswith("tmp_") or not os.path.isdir(entryDir):
+            continue
+        size = sum([os.path.getsize(os.path.join(entryDir, fileName)) for
+                    fileName in os.listdir(entryDir)])
+        entries.append((os.path.getmtime(entryDir), size, entryDir))
+        totalSize += size
+
+    for mtime, size, entryDir in sorted(entries):
+        if totalSize <= cacheSize:
+            break
+        shutil.rmtree(entryDir, ignore_errors=True)
+        totalSize -= size
 
 
 def parseArgs():
@@ -62,7 +406,8 @@ def parseArgs():
     descr = "Creates maps for VS with ICM, requires target in .ob as an ICM " \
             "object and library index in .inx format"
     descr_obPath = "Provide the path to the .ob file containing the target " \
-                   "for the VS"
+                   "for the VS. Several .ob files (an ensemble) each get " \
+                   "their own vs_setup_<name> directory"
     descr_inxPath = "Provide the path to the .inx index to the ligand " \
                     "to be used for this VS"
     descr_mapMode = "Choose map creation mode: 'ligand' create a map around " \
@@ -78,33 +423,87 @@ def parseArgs():
                    "ICMpocket finder). Default is pocket #1."
     descr_residues = "Provide a file containing the list of residues numbers" \
                      " to be used for map creation. Format: 1,2,3:10,20"
+    descr_nproc = "Number of receptors of an ensemble whose maps are built " \
+                  "at the same time. Default is 1"
+    descr_cache = "Shared directory caching the maps, reused when the " \
+                  "receptor, map mode, pocket or residues and grid " \
+                  "parameters are unchanged. Default is $VS_MAPS_CACHE, if set"
+    descr_cacheSize = "Size limit of the maps cache in GB, least recently " \
+                      "used maps are evicted past it. Default is 50"
+    descr_topPockets = "Pocket mode: run ICMpocketFinder once, write the " \
+                       "ranked pocket list to <name>_pockets.csv and build " \
+                       "maps for the N largest pockets in parallel, each in " \
+                       "its own vs_setup_<name>_pocket<i> directory. " \
+                       "Replaces --pocket"
 
     # Parse arguments
     parser = argparse.ArgumentParser(description=descr)
-    parser.add_argument("obPath", help=descr_obPath)
+    parser.add_argument("obPath", help=descr_obPath, nargs="+")
     parser.add_argument("inxPath", help=descr_inxPath)
     parser.add_argument("dbType", help=descr_dbType)
     parser.add_argument("mapMode", help=descr_mapMode)
     parser.add_argument("--pocket", help=descr_pocket)
     parser.add_argument("--resPath", help=descr_residues)
+    parser.add_argument("--nproc", help=descr_nproc)
+    parser.add_argument("--cache", help=descr_cache)
+    parser.add_argument("--cacheSize", help=descr_cacheSize)
+    parser.add_argument("--topPockets", help=descr_topPockets)
     args = parser.parse_args()
 
     # Store arguments
-    obPath = args.obPath
+    obPaths = args.obPath
     inxPath = args.inxPath
     dbType = args.dbType
     mapMode = args.mapMode
     pocket = args.pocket
     resPath = args.resPath
+    nproc = args.nproc
+    cacheDir = args.cache
+    cacheSize = args.cacheSize
+    topPockets = args.topPockets
 
     # Deal with arguments
     if not pocket:
         pocket = "1"
 
+    if nproc:
+        nproc = int(nproc)
+    else:
+        nproc = 1
+
+    # The cache is off unless given here or in the environment
+    if not cacheDir:
+        cacheDir = os.environ.get("VS_MAPS_CACHE")
+    if cacheSize:
+        cacheSize = int(float(cacheSize) * 1024 ** 3)
+    else:
+        cacheSize = 50 * 1024 ** 3
+
     if mapMode not in ("ligand", "pocket", "residues"):
         print ("Either use option 'pocket', 'ligand' or 'residues' for map mode creation")
         sys.exit()
 
+    if topPockets:
+        topPockets = int(topPockets)
+        if mapMode != "pocket":
+            print("Option --topPockets requires the 'pocket' map mode")
+            sys.exit()
+
+    # The setup directories, pocket lists and .icb files of the receptors are
+    # named after their base name, and written side by side
+    baseNames = {}
+    for obPath in obPaths:
+        baseName = os.path.basename(obPath).replace(".ob", "")
+        baseNames.setdefault(baseName, []).append(obPath)
+    clashes = [paths for baseName, paths in sorted(baseNames.items())
+               if len(paths) > 1]
+    if clashes:
+        print("Receptors must have distinct file names, their setup files " +
+              "are named after them:")
+        for paths in clashes:
+            print("\t" + " ".join(paths))
+        sys.exit()
+
     if dbType not in ("3D", "2Drac"):
         print("For the ligand database type, use either '3D' or '2Drac'")
         sys.exit()
@@ -122,7 +521,8 @@ def parseArgs():
     else:
         residues = ""
 
-    return obPath, inxPath, dbType, mapMode, pocket, residues
+    return obPaths, inxPath, dbType, mapMode, pocket, residues, nproc, \
+        cacheDir, cacheSize, topPockets
 
 
 def getPath():
@@ -143,10 +543,12 @@ def getPath():
     return icm
 
 
-def generateScript(mapMode, obPath, pocket, icm, residues):
+def generateScript(mapMode, obPath, pocket, icm, residues, workDir,
+                   icbPath=None):
     """
     The scripts are generated here, and their content is modified to fit the
-    tasks they are supposed to carry out
+    tasks they are supposed to carry out. Each script gets a unique name in
+    the work directory (the current one by default)
     """
 
     # Ligand-script base
@@ -165,7 +567,7 @@ delete a_VS_PROJ.2
 currentDockProj.data[8] = "yes"
 tempsel = as_graph
 dock2SetupReceptor "VS_PROJ" a_ tempsel no "none"
-dock5CalcMaps "VS_PROJ" 0.5 4.0 no
+dock5CalcMaps "VS_PROJ" MAP_PARAMS no
 currentDockProj.data[1] = "VS_PROJ"
 
 quit
@@ -187,7 +589,27 @@ as_graph = Sphere( g_pocketPOCKET_NUM a_VS_PROJ. 2.5)
 currentDockProj.data[8] = "yes"
 tempsel = as_graph
 dock2SetupReceptor "VS_PROJ" a_ tempsel no "none"
-dock5CalcMaps "VS_PROJ" 0.5 4.0 no
+dock5CalcMaps "VS_PROJ" MAP_PARAMS no
+currentDockProj.data[1] = "VS_PROJ"
+
+quit
+"""
+
+    # Pocket-script base, pockets already found and saved by findPockets
+    scrPokIcb_string = """#!ICM_EXEC
+
+call "_startup"
+
+openFile "ICB_PATH"
+
+# Create sphere around the pocket
+as_graph = Sphere( g_pocketPOCKET_NUM a_VS_PROJ. 2.5)
+
+# Setup docking project
+currentDockProj.data[8] = "yes"
+tempsel = as_graph
+dock2SetupReceptor "VS_PROJ" a_ tempsel no "none"
+dock5CalcMaps "VS_PROJ" MAP_PARAMS no
 currentDockProj.data[1] = "VS_PROJ"
 
 quit
@@ -207,7 +629,7 @@ as_graph = a_VS_PROJ./RESIDUE_LIST
 currentDockProj.data[8] = "yes"
 tempsel = as_graph
 dock2SetupReceptor "VS_PROJ" a_ tempsel no "none"
-dock5CalcMaps "VS_PROJ" 0.5 4.0 no
+dock5CalcMaps "VS_PROJ" MAP_PARAMS no
 currentDockProj.data[1] = "VS_PROJ"
 
 quit
@@ -219,6 +641,12 @@ quit
         scr_string = scrLig_string
         scr_string = scr_string.replace("ICM_EXEC", icm)
         scr_string = scr_string.replace("VS_PROJ", projName)
+    elif mapMode == "pocket" and icbPath:
+        scr_string = scrPokIcb_string
+        scr_string = scr_string.replace("ICM_EXEC", icm)
+        scr_string = scr_string.replace("ICB_PATH", icbPath)
+        scr_string = scr_string.replace("VS_PROJ", projName)
+        scr_string = scr_string.replace("POCKET_NUM", pocket)
     elif mapMode == "pocket":
         scr_string = scrPok_string
         scr_string = scr_string.replace("ICM_EXEC", icm)
@@ -229,61 +657,37 @@ quit
         scr_string = scr_string.replace("ICM_EXEC", icm)
         scr_string = scr_string.replace("VS_PROJ", projName)
         scr_string = scr_string.replace("RESIDUE_LIST", residues)
+    scr_string = scr_string.replace("MAP_PARAMS", MAP_PARAMS)
 
     # Write the selected script to a file
-    workDir = os.getcwd()
-    scr_path = workDir + "/temp.icm"
-    with open(scr_path, "w") as scr_file:
+    if not workDir:
+        workDir = os.getcwd()
+    scr_fd, scr_path = tempfile.mkstemp(prefix="temp_", suffix=".icm",
+                                        dir=workDir)
+    with os.fdopen(scr_fd, "w") as scr_file:
         scr_file.write(scr_string)
 
     return scr_path
 
 
-def runScript(icm, script):
+def runScript(icm, script, workDir):
     """
-    This modifies and runs the script creating the maps around the bound ligand
+    This runs the script creating the maps, from within the work directory.
+    Returns the ICM output if it failed, None otherwise
     """
 
     # Execute
+    error = None
     try:
-        check_output(icm + " -s " + script, stderr=STDOUT, shell=True)
+        check_output(icm + " -s " + script, stderr=STDOUT, shell=True,
+                     cwd=workDir)
     except CalledProcessError as e:
-        print(e.output)
-        sys.exit()
+        error = e.output
 
     # Delete temp script
     os.remove(script)
 
-
-def modifyDtb(keyword, value, obPath):
-    """
-    Make modifications to the .dtb file to fine tune parameters
-    """
-
-    dtbPath = obPath.replace(".ob", ".dtb")
-    dtbFile = open(dtbPath, "r")
-    dtbLines = dtbFile.readlines()
-    dtbFile.close()
-
-    totalLines = len(dtbLines)
-    newDtbLines = []
-    i = 0
-
-    # print dtbLines[i]
-
-    while i < totalLines:
-        if keyword in dtbLines[i]:
-            newDtbLines.append(dtbLines[i])
-            newDtbLines.append(value + "\n")
-            i += 2
-            continue
-        else:
-            newDtbLines.append(dtbLines[i])
-            i += 1
-
-    newDtbFile = open(dtbPath, "w")
-    for line in newDtbLines:
-        newDtbFile.write(line)
+    return error
 
 
 if __name__ == "__main__":
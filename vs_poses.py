@@ -4,6 +4,10 @@
 # following a VS. Loads them using ICM and saves the poses wanted to a single
 # .pdb file. Also saves the receptor to that .pdb file. That file can then be
 # opened using ICM or an other molecular viewer.
+# The answers files (.ob) of each repeat are those listed in the manifest of
+# the VS (vs_manifest.json written by vs_build.py), or found in the repeat
+# directories without one. Ligands docked from the sub-library of their slice
+# (vs_build.py --sublib) are looked up under their ID in it.
 
 # https://github.com/thomas-coudrat/toolbx_vs
 # Thomas Coudrat <thomas.coudrat@gmail.com>
@@ -17,6 +21,7 @@ import argparse
 import socket
 from subprocess import check_output, STDOUT, CalledProcessError
 import json
+import manifest
 
 
 def main():
@@ -32,7 +37,11 @@ def main():
     cwd = os.getcwd()
     vsPath = os.path.dirname(cwd + "/" + resultsPath)
     #projName = os.path.basename(os.path.dirname(cwd + "/" + resultsPath))
-    projName = os.path.basename(glob.glob(cwd + "/*.log")[0]).replace(".log", "")
+    vsManifest = manifest.load(vsPath)
+    if vsManifest:
+        projName = vsManifest.project
+    else:
+        projName = os.path.basename(glob.glob(cwd + "/*.log")[0]).replace(".log", "")
 
     # Parse the VS results
     resDataAll = parseResultsCsv(resultsPath)
@@ -47,7 +56,8 @@ def main():
     repeatsRes = posesPerRepeat(resDataSel)
 
     # Load those poses and save them in the /poses directory
-    loadAnswersWritePoses(repeatsRes, vsPath, projName, label, icm)
+    loadAnswersWritePoses(repeatsRes, vsPath, projName, label, icm,
+                          vsManifest)
 
     print("\n")
 
@@ -231,9 +241,11 @@ def posesPerRepeat(resData):
     return repeatsRes
 
 
-def loadAnswersWritePoses(repeatsRes, vsPath, projName, label, icm):
+def loadAnswersWritePoses(repeatsRes, vsPath, projName, label, icm,
+                          vsManifest=None):
     """
-    Walk through repeat directories, and load each
+    Walk through repeat directories, and load each. The answers files, and
+    ligand IDs in them, are those listed in the manifest if given
     """
     # Create the results directory, delete it if already exists
     resultsPath = vsPath + "/poses/"
@@ -249,7 +261,10 @@ def loadAnswersWritePoses(repeatsRes, vsPath, projName, label, icm):
         repPath = vsPath + "/" + key + "/"
         # Ligands found in that repeat
         ligsInfo = [[row[1], ""] for row in repeatsRes[key]]
-        obFileList = getAnswersList(repPath, ligsInfo)
+        answers = None
+        if vsManifest and key in vsManifest.repeats():
+            answers = vsManifest.answers(key)
+        obFileList = getAnswersList(repPath, ligsInfo, answers)
 
         # Get the pdb file list
         pdbFileList = []
@@ -261,7 +276,13 @@ def loadAnswersWritePoses(repeatsRes, vsPath, projName, label, icm):
             ligScore = row[3]
             pdbFilePath = resultsPath + str(ligRank) + "_" + str(ligScore) + \
                 "_" + str(ligID) + "_" + ligName + "_" + label + ".pdb"
-            selectionName = projName.replace("-", "_") + str(ligID)
+            # Ligands docked from a sub-library are named after their
+            # position in it
+            if vsManifest and key in vsManifest.repeats():
+                selectionName = projName.replace("-", "_") + \
+                    str(vsManifest.localID(key, ligID))
+            else:
+                selectionName = projName.replace("-", "_") + str(ligID)
             icmName = "a_" + selectionName + "."
 
             pdbFileList.append([selectionName, icmName, pdbFilePath])
@@ -269,16 +290,22 @@ def loadAnswersWritePoses(repeatsRes, vsPath, projName, label, icm):
         readAndWrite(obFileList, pdbFileList, projName, vsPath, icm)
 
 
-def getAnswersList(repPath, ligsInfo):
+def getAnswersList(repPath, ligsInfo, answers=None):
     """
     Given a repeat directory path and a list of ligand IDs, return the list
     of VS answers (.ob files) that contain all the ligand IDs provided.
+    The answers files can be given with their first ligand ID, as listed in
+    the manifest
     """
 
     # Get a list of all the files, and make is an sorted list
-    allObFiles = glob.glob(repPath + "*_answers*.ob")
-    allObFiles = [[obFile, int(obFile.split("_answers")[1].replace(".ob", ""))]
-                  for obFile in allObFiles]
+    if answers is not None:
+        allObFiles = answers
+    else:
+        allObFiles = glob.glob(repPath + "*_answers*.ob")
+        allObFiles = [[obFile,
+                       int(obFile.split("_answers")[1].replace(".ob", ""))]
+                      for obFile in allObFiles]
     sortedObFiles = sorted(allObFiles, key=lambda obFile: obFile[1],
                            reverse=True)
     for obFile in sortedObFiles:
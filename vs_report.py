@@ -3,6 +3,10 @@
 # Run in a VS repeat directory, checks all .ou files and
 # compiles the number of occurence of the 'SCORE' word in
 # order to inform about the status of that repeat
+# The repeats and .ou files are those listed in the manifest of the VS
+# (vs_manifest.json written by vs_build.py), which also gives the number of
+# ligands each repeat docks. Without a manifest, they are found in the VS
+# directory.
 #
 # https://github.com/thomas-coudrat/toolbx_vs
 # Thomas Coudrat <thomas.coudrat@gmail.com>
@@ -10,6 +14,7 @@
 import glob
 import os
 import argparse
+import manifest
 
 def main():
     """
@@ -42,21 +47,32 @@ def loopOverRepeats(workDir):
     specs = {}
     skipCount = 0
 
+    vsManifest = manifest.load(workDir)
+
     # Loop through the directories in this VS
-    for subDir in os.listdir(workDir):
+    for subDir in repeatDirs(workDir, vsManifest):
         # Check only repeat directories
         if subDir.isdigit():
             dirPath = os.path.join(workDir, subDir)
 
             # Get all the *.ou files in this dir
-            ouFiles = glob.glob(dirPath + "/*.ou")
+            ligandCount = None
+            if vsManifest:
+                ouFiles = vsManifest.outputs(subDir)
+                ligandCount = vsManifest.ligandCount(subDir)
+            else:
+                ouFiles = glob.glob(dirPath + "/*.ou")
 
             scoreCount = 0
             # Looping over .ou files in the current dir
             for file in ouFiles:
 
-                # Read all lines of that .ou file
-                f = open(file, "r")
+                # Read all lines of that .ou file, those of the manifest
+                # may not be written yet
+                try:
+                    f = open(file, "r")
+                except IOError:
+                    continue
                 lines = f.readlines()
                 f.close()
 
@@ -70,17 +86,33 @@ def loopOverRepeats(workDir):
                     # Update "Skipping" count
                     specs, skipCount = countSkipped(line, specs, skipCount)
 
-            printCompleted(subDir, scoreCount)
+            printCompleted(subDir, scoreCount, ligandCount)
 
     return specs, skipCount
 
 
-def printCompleted(subDir, scoreCount):
+def repeatDirs(workDir, vsManifest):
+    """
+    Repeat directories of the VS, from its manifest if it has one
+    """
+
+    if vsManifest:
+        return vsManifest.repeats()
+    else:
+        return os.listdir(workDir)
+
+
+def printCompleted(subDir, scoreCount, ligandCount=None):
     """
-    Print the score count for the current VS repeat
+    Print the score count for the current VS repeat, out of the number of
+    ligands it docks when known
     """
 
-    print("SCORE COUNT FOR " + subDir + ": " + str(scoreCount))
+    if ligandCount is None:
+        print("SCORE COUNT FOR " + subDir + ": " + str(scoreCount))
+    else:
+        print("SCORE COUNT FOR " + subDir + ": " + str(scoreCount) + " / " +
+              str(ligandCount))
 
 
 def countSkipped(line, specs, skipCount):
@@ -154,7 +186,7 @@ def printSlurmOuts(workDir):
     print("ERRORS?\n")
 
     # Loop through the directories in this VS
-    for subDir in os.listdir(workDir):
+    for subDir in repeatDirs(workDir, manifest.load(workDir)):
         # Check only repeat directories
         if subDir.isdigit():
             dirPath = os.path.join(workDir, subDir)
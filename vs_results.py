@@ -4,6 +4,14 @@
 # in the repeats of the current VS directory
 # Regroups the repeats together and extracts either only
 # the best score for each ligand, or all repeats.
+# Ligands left out of the VS as duplicate structures (vs_build.py --dupes) are
+# given back the results of their canonical ligand.
+# For a thoroughness funnel (vs_build.py --funnel), each ligand is given the
+# score of the last stage that docked it, with the thoroughness of that stage
+# read from the manifest in an added Thor column.
+# The .ou files read are those listed in the manifest of the VS
+# (vs_manifest.json written by vs_build.py), or found in its repeat
+# directories without one.
 #
 # https://github.com/thomas-coudrat/toolbx_vs
 # Thomas Coudrat <thomas.coudrat@gmail.com>
@@ -11,6 +19,9 @@
 import glob
 import os
 import argparse
+import copy
+import vs_index
+import manifest
 
 
 def main():
@@ -19,7 +30,7 @@ def main():
     """
 
     # Get arguments
-    vsDir, minRep, allRep = parseArguments()
+    vsDir, minRep, allRep, dupPath, funnel = parseArguments()
 
     # Get the project name out of the vsDir
     projName = os.path.basename(os.path.normpath(vsDir))
@@ -37,14 +48,28 @@ def main():
     # Returns ligDict (VS results) total number of repeats
     ligDict, totalRepeatNum = collectScoreData(vsDir, ligDict)
 
-    # Getting rid of the ligands that were not docking in all repeats attempted
-    ligDict = removeFailed(ligDict, totalRepeatNum, minRep)
+    # Copy the results of docked ligands to their duplicates
+    if dupPath:
+        ligDict = expandDupes(ligDict, dupPath)
+
+    # Getting rid of the ligands that were not docking in all repeats
+    # attempted. Funnel stages dock fewer ligands each, a ligand is scored by
+    # the last stage that docked it
+    if funnel:
+        resultDict = removeFailed(lastStages(ligDict), 1, 1)
+    else:
+        ligDict = removeFailed(ligDict, totalRepeatNum, minRep)
+        resultDict = ligDict
 
     # Sort each ligand docking amongst repeats
     ligDict = sortRepeats(ligDict)
+    resultDict = sortRepeats(resultDict)
+
+    # Thoroughness of each funnel stage, as recorded in the manifest
+    stageThors = stageThoroughness(vsDir) if funnel else None
 
     # Write the results in a .csv file
-    writeResultFiles(ligDict, projName, vsDir)
+    writeResultFiles(resultDict, projName, vsDir, stageThors)
 
     # Write out individual results files for each repeat, if requested
     if allRep:
@@ -71,18 +96,28 @@ def parseArguments():
         " the results. Default is max number of repeats"
     descr_allRep = "Print out all results from each repeat in a different" \
         " text file"
+    descr_dupes = "Duplicate report (.dup) used to build the VS with " \
+        "vs_build.py --dupes. Duplicates get the results of their canonical" \
+        " ligand"
+    descr_funnel = "Results of a thoroughness funnel (vs_build.py --funnel)" \
+        ": each ligand gets the score of the last stage that docked it, " \
+        "with the thoroughness of that stage in an added Thor column"
 
     # Defining the arguments
     parser = argparse.ArgumentParser(description=descr)
     parser.add_argument("vsDir", help=descr_vsDir)
     parser.add_argument("--minRep", help=descr_minRep)
     parser.add_argument("-allRep", action="store_true", help=descr_allRep)
+    parser.add_argument("--dupes", help=descr_dupes)
+    parser.add_argument("-funnel", action="store_true", help=descr_funnel)
 
     # Parsing arguments
     args = parser.parse_args()
     vsDir = args.vsDir
     minRep = args.minRep
     allRep = args.allRep
+    dupPath = args.dupes
+    funnel = args.funnel
 
     # Deal with minRep in case the option was not used in which case use a very
     # large int number. Otherwise make the minRep an int.
@@ -93,7 +128,7 @@ def parseArguments():
         # the repeat number be that high)
         minRep = 999999999999999999999
 
-    return vsDir, minRep, allRep
+    return vsDir, minRep, allRep, dupPath, funnel
 
 
 def collectScoreData(vsDir, ligDict):
@@ -105,12 +140,21 @@ def collectScoreData(vsDir, ligDict):
 
     maxRepeatNum = -1
 
-    # Get all .ou files in each repeat directory
-    ouFiles = glob.glob(vsDir + "/*/*.ou")
+    # Get all .ou files in each repeat directory, as listed in the manifest
+    vsManifest = manifest.load(vsDir)
+    if vsManifest:
+        ouFiles = vsManifest.outputs()
+    else:
+        ouFiles = glob.glob(vsDir + "/*/*.ou")
     # Loop through them and look for the 'SCORES' line
     for ouFilePath in ouFiles:
-        # Open file containing text result of the VLS
-        file = open(ouFilePath, "r")
+        # Open file containing text result of the VLS, outputs of the manifest
+        # may not be written yet
+        try:
+            file = open(ouFilePath, "r")
+        except IOError:
+            print("\t" + ouFilePath + "\tnot found")
+            continue
         lines = file.readlines()
         file.close()
 
@@ -190,6 +234,59 @@ def parseScoreLine(ligDict, line, repeatNum):
     return ligDict
 
 
+def expandDupes(ligDict, dupPath):
+    """
+    Give each duplicate ligand a copy of the results of its canonical ligand,
+    under its own ligand ID
+    """
+
+    dupes = vs_index.readDupes(dupPath)
+
+    dupCount = 0
+    for dupID, canonID in dupes.items():
+        if canonID in ligDict and dupID not in ligDict:
+            ligDict[dupID] = copy.deepcopy(ligDict[canonID])
+            for ligInfo in ligDict[dupID]:
+                ligInfo[0] = dupID
+            dupCount += 1
+
+    print("\n\t" + str(dupCount) + " duplicates given the results of their " +
+          "canonical ligand")
+
+    return ligDict
+
+
+def lastStages(ligDict):
+    """
+    Keep the results of each ligand from the last funnel stage (repeat
+    directory) that docked it
+    """
+
+    stageDict = {}
+    for ligID, ligInfos in ligDict.items():
+        lastStage = max([int(ligInfo[-1]) for ligInfo in ligInfos])
+        stageDict[ligID] = [ligInfo for ligInfo in ligInfos
+                            if int(ligInfo[-1]) == lastStage]
+
+    return stageDict
+
+
+def stageThoroughness(vsDir):
+    """
+    Return the thoroughness of each funnel stage by repeat directory, as
+    recorded in the manifest, None without one
+    """
+
+    vsManifest = manifest.load(vsDir)
+    if not vsManifest:
+        print("\nNo manifest in " + vsDir + ", the thoroughness of the "
+              "funnel stages is not written")
+        return None
+
+    return dict([(repeat, vsManifest.thoroughness(repeat))
+                 for repeat in vsManifest.repeats()])
+
+
 def removeFailed(ligDict, totalRepeatNum, minRepeatNum):
     """
     Loop over all results and remove those not successful for all repeats
@@ -262,9 +359,10 @@ def sortRepeats(ligDict):
     return ligDict
 
 
-def writeResultFiles(ligDict, projName, vsDir):
+def writeResultFiles(ligDict, projName, vsDir, stageThors=None):
     """
-    Write out the results of this VS
+    Write out the results of this VS. Funnel results get the thoroughness of
+    the stage of each score in an added column
     """
     # Write the ligand info
     keys = ligDict.keys()
@@ -285,11 +383,15 @@ def writeResultFiles(ligDict, projName, vsDir):
     print("\tresults_" + projName + ".csv")
     fileResult = open(vsDir + "/results_" + projName + ".csv", "w")
     fileResult.write("No,Nat,Nva,dEhb,dEgrid,dEin,dEsurf" +
-                     ",dEel,dEhp,Score,mfScore,Name,Run#\n")
+                     ",dEel,dEhp,Score,mfScore,Name,Run#" +
+                     (",Thor" if stageThors else "") + "\n")
 
     # Loop over the sorted results, and write to the result(s) file(s)
     for ligInfo in vsResult:
-        # Write single repeat result (the best repeat)
+        # Write single repeat result (the best repeat), with the thoroughness
+        # of its funnel stage
+        if stageThors:
+            ligInfo = ligInfo + [stageThors.get(str(ligInfo[-1]), "")]
         writeResultLine(ligInfo, fileResult)
 
     fileResult.close()
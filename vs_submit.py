@@ -4,6 +4,23 @@
 # all its subdirs and submit all .slurm or .sge
 # files found there, while pausing for 1 second
 # between each submission
+# With the local queuing system, the .local slices are run on the current
+# machine instead, by the local scheduler backend, --nproc at a time (the
+# number of cores by default). Their exit status and wall time are written to
+# local_status.csv in the VS directory. --icmExec replaces $ICMHOME/icm64 by
+# any ICM-compatible executable.
+# Jobs are submitted, queried and cancelled through the scheduler backends of
+# schedulers.py. With --resubmit N, the submitted jobs are watched until they
+# are all finished, failed jobs being submitted again up to N times. The mock
+# queuing system submits the .slurm scripts to a simulated cluster instead
+# (queue latency, run time, failure rate and slots set by --latency,
+# --runtime, --failRate and --slots), on a virtual clock: the submission
+# throughput, number of resubmissions and time until all jobs are finished
+# are reported in seconds, without a cluster nor waiting. Scripts that fail to
+# be submitted are reported, and submitted again as failed jobs with
+# --resubmit.
+# The job scripts are those listed in the manifest of the VS (vs_manifest.json
+# written by vs_build.py), or found in its repeat directories without one.
 #
 # https://github.com/thomas-coudrat/toolbx_vs
 # Thomas Coudrat <thomas.coudrat@gmail.com>
@@ -14,6 +31,10 @@ import argparse
 import sys
 import socket
 import json
+import csv
+import multiprocessing
+import schedulers
+import manifest
 
 def main():
     """
@@ -21,19 +42,33 @@ def main():
     """
 
     # Return the queuing system chosen
-    vsDir, queue = parsing()
-
-    # Get the current working directory
-    cwd = os.getcwd()
+    vsDir, queue, nproc, icmExec, pause, resubmit, poll, \
+        mockOptions = parsing()
+
+    # Scheduler backend of this queuing system
+    if queue == "mock":
+        backend = schedulers.getScheduler(queue, **mockOptions)
+    elif queue == "local":
+        backend = schedulers.getScheduler(queue, icmExec=icmExec)
+    else:
+        backend = schedulers.getScheduler(queue)
 
     # Store all queueing scripts to be submitted in this directory
-    queuePaths = getQueueScripts(vsDir, queue)
+    queuePaths = getQueueScripts(vsDir, backend.extension)
 
-    # Ask for confirmation to submit run
-    confirmSubmit(queuePaths)
+    # Ask for confirmation to submit run, nothing is submitted by the mock
+    # scheduler
+    if queue != "mock":
+        confirmSubmit(queuePaths)
 
-    # Submit all those scripts (using the proper queueing system)
-    submitQueueScripts(queuePaths, cwd, queue)
+    # Submit all those scripts (using the proper queueing system), or run
+    # them here
+    if queue == "local":
+        runLocalScripts(queuePaths, vsDir, nproc, backend)
+    else:
+        jobs = submitQueueScripts(queuePaths, backend, pause)
+        if resubmit is not None:
+            watchJobs(jobs, backend, resubmit, poll, vsDir, queue)
 
     print("")
 
@@ -46,22 +81,91 @@ def parsing():
     # Define and collect arguments
     descr = "Submits a VS using either -slurm or -sge queuing system"
     descr_vsDir = "VS directory to be submitted to the queue"
-    descr_queue = "Queuing system to be used (sge/slurm)"
+    descr_queue = "Queuing system to be used (sge/slurm/local)"
+    descr_nproc = "local: number of slices run at the same time. Default " \
+        "is the number of cores"
+    descr_icmExec = "local: docking executable used instead of " \
+        "$ICMHOME/icm64, with the same command line"
+    descr_pause = "Seconds between two submissions. Default is 1"
+    descr_resubmit = "Watch the jobs until they are all finished, " \
+        "submitting failed jobs again up to this number of times. " \
+        "Default for mock is 0"
+    descr_poll = "Seconds between two queries of the jobs watched. " \
+        "Default is 60"
+    descr_latency = "mock: average queue latency of a job in seconds. " \
+        "Default is 30"
+    descr_runtime = "mock: average run time of a job in seconds, killed " \
+        "past its walltime. Default is 600"
+    descr_failRate = "mock: probability of a job to fail. Default is 0"
+    descr_slots = "mock: number of jobs running at the same time. Default " \
+        "is unlimited"
+    descr_seed = "mock: random seed, to compare strategies on the same jobs"
 
     parser = argparse.ArgumentParser(description=descr)
     parser.add_argument("vsDir", help=descr_vsDir)
     parser.add_argument("queue", help=descr_queue)
+    parser.add_argument("--nproc", help=descr_nproc)
+    parser.add_argument("--icmExec", help=descr_icmExec)
+    parser.add_argument("--pause", help=descr_pause)
+    parser.add_argument("--resubmit", help=descr_resubmit)
+    parser.add_argument("--poll", help=descr_poll)
+    parser.add_argument("--latency", help=descr_latency)
+    parser.add_argument("--runtime", help=descr_runtime)
+    parser.add_argument("--failRate", help=descr_failRate)
+    parser.add_argument("--slots", help=descr_slots)
+    parser.add_argument("--seed", help=descr_seed)
 
     args = parser.parse_args()
 
     vsDir = args.vsDir
     queue = args.queue
-
-    if queue not in ("sge", "slurm"):
-        print("Only 'sge' and 'slurm' are accepted queuing system options")
+    nproc = args.nproc
+    icmExec = args.icmExec
+    pause = args.pause
+    resubmit = args.resubmit
+    poll = args.poll
+
+    if queue not in ("sge", "slurm", "local", "mock"):
+        print("Only 'sge', 'slurm', 'local' and 'mock' are accepted queuing "
+              "system options")
         sys.exit()
 
-    return vsDir, queue
+    if pause:
+        pause = float(pause)
+    else:
+        pause = 1.
+
+    if resubmit:
+        resubmit = int(resubmit)
+    elif queue == "mock":
+        resubmit = 0
+
+    if poll:
+        poll = float(poll)
+    else:
+        poll = 60.
+
+    mockOptions = {}
+    for option, convert in (("latency", float), ("runtime", float),
+                            ("failRate", float), ("slots", int),
+                            ("seed", int)):
+        value = getattr(args, option)
+        if value is not None:
+            if queue != "mock":
+                print("--" + option + " is only used by the mock queuing "
+                      "system")
+                sys.exit()
+            mockOptions[option] = convert(value)
+
+    if nproc:
+        nproc = int(nproc)
+    else:
+        nproc = multiprocessing.cpu_count()
+
+    if icmExec:
+        icmExec = os.path.abspath(icmExec)
+
+    return vsDir, queue, nproc, icmExec, pause, resubmit, poll, mockOptions
 
 
 def confirmSubmit(queuePaths):
@@ -81,11 +185,16 @@ def confirmSubmit(queuePaths):
         sys.exit()
 
 
-def getQueueScripts(vsDir, queue):
+def getQueueScripts(vsDir, extension):
     """
-    Make a list of the scripts to be submited
+    Make a list of the scripts to be submited, those of the last build in the
+    manifest if the VS has one
     """
 
+    vsManifest = manifest.load(vsDir)
+    if vsManifest:
+        return vsManifest.jobs(extension)
+
     queuePaths = []
     # Listing direct subdirectories to the dir where this was executed
     for subDir in os.listdir(vsDir):
@@ -96,40 +205,132 @@ def getQueueScripts(vsDir, queue):
             # For each of these, save every file that ends with .slurm or
             # .sge in a list, by saving its full path
             for file in files:
-                if file.endswith("." + queue):
+                if file.endswith("." + extension):
                     queuePaths.append(os.path.join(path, file))
 
     return queuePaths
 
 
-def submitQueueScripts(queuePaths, cwd, queue):
+def submitQueueScripts(queuePaths, backend, pause):
     """
-    Submit all the queueing scripts
+    Submit all the queueing scripts, pausing between submissions, and report
+    the submission throughput. Returns the job ID of each script, None for
+    those whose submission failed
     """
 
+    jobs = {}
+    start = backend.now()
+
     # Loop over the saved .slurm or .sge paths
-    for queuePath in queuePaths:
-
-        # Get the full path relative to the root
-        queueFullPath = os.path.join(cwd, queuePath)
-
-        # Get the directory name and the file name separately
-        queueDir = os.path.dirname(queueFullPath)
-        queueFile = os.path.basename(queuePath)
-        # print queuePath, queueDir
-
-        # Change to that repeat directory
-        # queuePath = os.path.joindir(cwd, queueDir)
-        os.chdir(queueDir)
-        # And submit using either SLURM or SGE queueing
-        # system depending on what was chosen
-        if queue == "slurm":
-            # print "sbatch " + queueFile
-            os.system("sbatch " + queueFile)
-        elif queue == "sge":
-            # print "qsub " + queueFile
-            os.system("qsub " + queueFile)
-        time.sleep(1)
+    for queuePath in sorted(queuePaths):
+        jobs[queuePath] = backend.submit(queuePath)
+        backend.sleep(pause)
+
+    seconds = backend.now() - start
+    failed = [queuePath for queuePath in sorted(jobs)
+              if jobs[queuePath] is None]
+    for queuePath in failed:
+        print("\tsubmission failed: " + queuePath)
+    print("\n" + str(len(jobs) - len(failed)) + " jobs submitted in " +
+          str(round(seconds, 1)) + " s" +
+          (", " + str(round(len(jobs) * 60. / seconds, 1)) + " jobs/min"
+           if seconds else ""))
+
+    return jobs
+
+
+def watchJobs(jobs, backend, resubmit, poll, vsDir, queue):
+    """
+    Query the jobs every poll seconds until they are all finished, submitting
+    failed jobs again up to resubmit times each. Scripts whose submission
+    failed count as failed jobs. The final state, job ID and number of
+    submissions of each script are written to <queue>_status.csv
+    """
+
+    start = backend.now()
+    submissions = dict([(queuePath, 1) for queuePath in jobs])
+    states = {}
+
+    while True:
+        for queuePath in sorted(jobs):
+            if states.get(queuePath) in schedulers.FINISHED:
+                continue
+            if jobs[queuePath] is None:
+                state = schedulers.FAILED
+            else:
+                state = backend.query(jobs[queuePath])
+            if state == schedulers.FAILED and \
+                    submissions[queuePath] <= resubmit:
+                print("\tresubmitting " + os.path.relpath(queuePath, vsDir))
+                jobs[queuePath] = backend.submit(queuePath)
+                submissions[queuePath] += 1
+                state = schedulers.PENDING
+            states[queuePath] = state
+
+        if not [state for state in states.values()
+                if state not in schedulers.FINISHED]:
+            break
+        backend.sleep(poll)
+
+    statusPath = os.path.join(vsDir, queue + "_status.csv")
+    with open(statusPath, "w") as statusFile:
+        statusWriter = csv.writer(statusFile)
+        statusWriter.writerow(["slice", "job", "status", "submissions"])
+        for queuePath in sorted(jobs):
+            statusWriter.writerow([os.path.relpath(queuePath, vsDir),
+                                   jobs[queuePath], states[queuePath],
+                                   submissions[queuePath]])
+
+    stateCounts = [str(list(states.values()).count(state)) + " " +
+                   state.lower() for state in schedulers.FINISHED]
+    print("\n" + ", ".join(stateCounts) + ", " +
+          str(sum(submissions.values()) - len(jobs)) + " resubmissions, " +
+          "all finished " + str(round(backend.now() - start, 1)) +
+          " s after the submissions: " + statusPath)
+
+
+def runLocalScripts(queuePaths, vsDir, nproc, backend):
+    """
+    Run the local slices on this machine through the local backend, nproc at
+    a time, and write the exit status and wall time of each to
+    local_status.csv
+    """
+
+    pending = sorted(queuePaths)
+    running = {}
+
+    statusPath = os.path.join(vsDir, "local_status.csv")
+    failed = 0
+    with open(statusPath, "w") as statusFile:
+        statusWriter = csv.writer(statusFile)
+        statusWriter.writerow(["slice", "status", "seconds"])
+
+        while pending or running:
+            # Keep nproc slices running
+            while pending and len(running) < max(1, nproc):
+                queuePath = pending.pop(0)
+                running[queuePath] = (backend.submit(queuePath), time.time())
+
+            for queuePath in sorted(running):
+                jobID, start = running[queuePath]
+                if backend.query(jobID) not in schedulers.FINISHED:
+                    continue
+                del running[queuePath]
+                status = backend.exitStatus(jobID)
+                seconds = time.time() - start
+                slicePath = os.path.relpath(queuePath, vsDir)
+                statusWriter.writerow([slicePath, status, round(seconds, 1)])
+                statusFile.flush()
+                print("\t{:<50} {:>4} {:>10.1f} s".format(slicePath, status,
+                                                          seconds))
+                if status != 0:
+                    failed += 1
+
+            if running:
+                backend.sleep(0.5)
+
+    print("\n" + str(len(queuePaths) - failed) + " slices completed, " +
+          str(failed) + " failed: " + statusPath)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+# Worker of a packed node allocation (vs_build.py slurm-srun --workers).
+# Pulls bash slice scripts one at a time from a shared queue file, protected
+# by a POSIX lock, and runs them until the queue is empty. Workers that get
+# light slices simply pull more of them, instead of idling until the slowest
+# slice of the allocation is done.
+# Each slice run is appended to <queue>.done: script, exit status, seconds
+# and host.
+#
+# https://github.com/thomas-coudrat/toolbx_vs
+# Thomas Coudrat <thomas.coudrat@gmail.com>
+
+import os
+import sys
+import argparse
+import fcntl
+import socket
+import subprocess
+import time
+
+
+def main():
+    """
+    Run script
+    """
+
+    queuePath = parseArgs()
+
+    # Slices are run from the directory of the queue
+    queueDir = os.path.dirname(os.path.abspath(queuePath))
+
+    sliceCount = 0
+    while True:
+        script = popSlice(queuePath)
+        if script is None:
+            break
+
+        start = time.time()
+        status = subprocess.call(["bash", script], cwd=queueDir)
+        logSlice(queuePath, script, status, time.time() - start)
+        sliceCount += 1
+
+    print(socket.gethostname() + ": " + str(sliceCount) + " slices run")
+
+
+def parseArgs():
+    """
+    Create arguments and parse them
+    """
+
+    descr = "Run the slice scripts of a queue file until it is empty"
+    descr_queuePath = "Queue file listing one slice script per line, " \
+        "relative to its directory"
+
+    parser = argparse.ArgumentParser(description=descr)
+    parser.add_argument("queuePath", help=descr_queuePath)
+
+    args = parser.parse_args()
+    queuePath = args.queuePath
+
+    if not os.path.exists(queuePath):
+        print("Queue file not found: " + queuePath)
+        sys.exit()
+
+    return queuePath
+
+
+def popSlice(queuePath):
+    """
+    Take the first slice script out of the queue file, under an exclusive
+    lock so that no two workers get the same slice. Returns None once the
+    queue is empty
+    """
+
+    with open(queuePath, "r+") as queueFile:
+        fcntl.lockf(queueFile, fcntl.LOCK_EX)
+        try:
+            scripts = [line.strip() for line in queueFile if line.strip()]
+            if not scripts:
+                return None
+            queueFile.seek(0)
+            queueFile.truncate()
+            queueFile.write("".join([script + "\n" for script in scripts[1:]]))
+            queueFile.flush()
+            os.fsync(queueFile.fileno())
+        finally:
+            fcntl.lockf(queueFile, fcntl.LOCK_UN)
+
+    return scripts[0]
+
+
+def logSlice(queuePath, script, status, seconds):
+    """
+    Append the exit status and run time of a slice to <queue>.done
+    """
+
+    with open(queuePath + ".done", "a") as doneFile:
+        fcntl.lockf(doneFile, fcntl.LOCK_EX)
+        try:
+            doneFile.write("\t".join([script, str(status),
+                                      str(round(seconds, 1)),
+                                      socket.gethostname()]) + "\n")
+            doneFile.flush()
+        finally:
+            fcntl.lockf(doneFile, fcntl.LOCK_UN)
+
+
+if __name__ == "__main__":
+    main()